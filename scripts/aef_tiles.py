@@ -19,31 +19,173 @@ Two behaviours deliberately differ from the JS, both about not destroying data:
    than into the AOI's input folder, so a partial or interrupted run cannot
    leave stray tiles behind for the next run to mistake for real input.
 
+Every stitch records each tile's SHA-256 and footprint in a sidecar
+(`<output>.tiles.json`). With `--delta`, a new export is compared against it
+and only the grid cells under added, changed or removed tiles are re-merged,
+into a copy of the existing mosaic that then replaces it. The cells rewritten
+are listed in `<output>.changes.json` (pixel windows and map bounds) for
+downstream stages to invalidate. A grid change - a tile that widens the AOI,
+a different resolution or band count - or a mosaic edited since the sidecar
+was written falls back to a full stitch. GDAL appends rewritten compressed
+blocks rather than reusing their space, so a mosaic grows a little with each
+delta; a plain (non-delta) run compacts it again.
+
 Usage:
     uv run --no-project --with rasterio,numpy,pyyaml python scripts/aef_tiles.py \
-        [--aoi auroville-24-10] [--zip path/to/aef_tiles.zip]
+        [--aoi auroville-24-10] [--zip path/to/aef_tiles.zip] [--delta] \
+        [--profile-out trace.json]
 """
 import argparse
+import hashlib
+import json
 import shutil
 import sys
 import tempfile
 import zipfile
 from pathlib import Path
 
+import numpy as np
 import rasterio
+from rasterio.coords import disjoint_bounds
 from rasterio.merge import merge
+from rasterio.transform import Affine
+from rasterio.windows import Window
+from rasterio.windows import bounds as window_bounds
 
 sys.path.insert(0, str(Path(__file__).resolve().parent))
 from esri_tiles import load_config  # noqa: E402  - shared config chain, one definition
+from lib.partition import Partition, mosaic_cores, plan_partitions, run_partitions  # noqa: E402
+from lib.profiling import Profiler, add_profile_args  # noqa: E402
 
 CREATION = dict(compress="ZSTD", zstd_level=9, interleave="pixel")
+DELTA_CELL = 1024
+
+
+def sidecar_paths(out_path: Path) -> tuple[Path, Path]:
+    """(tile manifest, change list) beside the mosaic."""
+    return out_path.with_suffix(".tiles.json"), out_path.with_suffix(".changes.json")
+
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def tile_records(tiles: dict[str, Path]) -> dict[str, dict]:
+    """Hash and footprint of each tile, keyed by its name inside the zip."""
+    records = {}
+    for name, path in tiles.items():
+        with rasterio.open(path) as src:
+            records[name] = {"sha256": file_sha256(path), "bounds": list(src.bounds)}
+    return records
+
+
+def grid_record(ds) -> dict:
+    return {"crs": ds.crs.to_string() if ds.crs else None, "transform": list(ds.transform)[:6],
+            "width": ds.width, "height": ds.height, "count": ds.count, "dtype": ds.dtypes[0]}
+
+
+def expected_grid(tile_paths) -> dict:
+    """The grid `merge` picks for these tiles: union of bounds at the first tile's res."""
+    with rasterio.open(tile_paths[0]) as first:
+        crs, count, dtype = first.crs, first.count, first.dtypes[0]
+        xres, yres = first.res
+    bounds = []
+    for p in tile_paths:
+        with rasterio.open(p) as src:
+            bounds.append(src.bounds)
+    west, north = min(b.left for b in bounds), max(b.top for b in bounds)
+    east, south = max(b.right for b in bounds), min(b.bottom for b in bounds)
+    return {"crs": crs.to_string() if crs else None,
+            "transform": list(Affine(xres, 0, west, 0, -yres, north))[:6],
+            "width": round((east - west) / xres), "height": round((north - south) / yres),
+            "count": count, "dtype": dtype}
+
+
+def write_json(path: Path, payload: dict) -> None:
+    tmp = path.with_suffix(".partial.json")
+    with open(tmp, "w") as f:
+        json.dump(payload, f, indent=2)
+    tmp.replace(path)
+
+
+def record_tiles(out_path: Path, records: dict[str, dict], windows: list[Window] | None):
+    """Write the tile manifest and the change list; `windows=None` means everything changed."""
+    manifest_path, changes_path = sidecar_paths(out_path)
+    with rasterio.open(out_path) as ds:
+        grid = grid_record(ds)
+        if windows is None:
+            windows = [Window(0, 0, ds.width, ds.height)]
+        changes = [{"window": [int(w.col_off), int(w.row_off), int(w.width), int(w.height)],
+                    "bounds": list(ds.window_bounds(w))} for w in windows]
+    st = out_path.stat()
+    write_json(manifest_path, {"output": {"size": st.st_size, "mtime_ns": st.st_mtime_ns},
+                               "grid": grid, "tiles": records})
+    write_json(changes_path, {"full": len(changes) == 1 and changes[0]["window"]
+                              == [0, 0, grid["width"], grid["height"]],
+                              "windows": changes})
+
+
+def _overlaps(a, b) -> bool:
+    """Bounds share area; `disjoint_bounds` also counts a shared edge as touching."""
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
 
+def plan_delta(out_path: Path, tiles: dict[str, Path],
+               records: dict[str, dict]) -> tuple[list[Partition] | None, str]:
+    """Grid cells to re-merge, or None (with the reason) when a full stitch is needed."""
+    manifest_path, _ = sidecar_paths(out_path)
+    if not out_path.exists() or not manifest_path.exists():
+        return None, "no previous mosaic or tile manifest"
+    with open(manifest_path) as f:
+        previous = json.load(f)
+    st = out_path.stat()
+    if previous["output"] != {"size": st.st_size, "mtime_ns": st.st_mtime_ns}:
+        return None, f"{out_path.name} changed since its tile manifest was written"
+    grid = expected_grid(list(tiles.values()))
+    if previous["grid"] != grid:
+        return None, "mosaic grid changed"
 
-def stitch(tile_paths, out_path: Path):
+    old = previous["tiles"]
+    touched = {n for n in old.keys() | records.keys()
+               if old.get(n, {}).get("sha256") != records.get(n, {}).get("sha256")}
+    # A changed tile may have moved: clear where it was and fill where it is.
+    dirty = [t[n]["bounds"] for n in touched for t in (old, records) if n in t]
+    transform = Affine(*grid["transform"])
+    cells = [cell for cell in plan_partitions(grid["height"], grid["width"], DELTA_CELL)
+             if any(_overlaps(window_bounds(cell.window, transform), b) for b in dirty)]
+    return cells, f"{len(touched)} of {len(records)} tiles added, changed or removed"
+
+
+def stitch_delta(tile_paths, out_path: Path, cells: list[Partition], workers: int = 1,
+                 profiler: Profiler | None = None):
+    """Re-merge `cells` of an existing mosaic from the new tiles; the rest is kept as is."""
+    profiler = profiler or Profiler("aef_tiles")
+    tmp = out_path.with_suffix(".partial.tif")
+    with profiler.stage("copy_mosaic"):
+        shutil.copyfile(out_path, tmp)
+    with rasterio.open(tmp, "r+") as dst:
+        grid = dst.transform
+        with profiler.stage("merge_cells", pixels=sum(c.pixels for c in cells), hot=True):
+            results = run_partitions(stitch_partition, cells, workers,
+                                     initializer=_init_partition_worker,
+                                     initargs=(tile_paths, grid))
+            mosaic_cores(dst, zip(cells, results))
+    tmp.replace(out_path)
+    return out_path
+
+
+def stitch(tile_paths, out_path: Path, profiler: Profiler | None = None):
     """Mosaic same-CRS tiles into one raster, matching `gdalwarp <tiles> out`."""
+    profiler = profiler or Profiler("aef_tiles")
     srcs = [rasterio.open(p) for p in tile_paths]
     try:
-        mosaic, transform = merge(srcs)
+        with profiler.stage("merge", hot=True) as st:
+            mosaic, transform = merge(srcs)
+            st.add_pixels(mosaic.shape[1] * mosaic.shape[2])
         profile = srcs[0].profile.copy()
         profile.update(height=mosaic.shape[1], width=mosaic.shape[2],
                        transform=transform, count=mosaic.shape[0], **CREATION)
@@ -51,8 +193,10 @@ def stitch(tile_paths, out_path: Path):
         # Write beside the destination, then move: a half-written mosaic must
         # never be able to occupy the path the pipeline reads from.
         tmp = out_path.with_suffix(".partial.tif")
-        with rasterio.open(tmp, "w", **profile) as dst:
-            dst.write(mosaic)
+        with profiler.stage("write_zstd", pixels=mosaic.shape[1] * mosaic.shape[2],
+                            hot=True):
+            with rasterio.open(tmp, "w", **profile) as dst:
+                dst.write(mosaic)
         tmp.replace(out_path)
     finally:
         for s in srcs:
@@ -60,11 +204,74 @@ def stitch(tile_paths, out_path: Path):
     return out_path
 
 
+_srcs: list = []
+_grid: Affine | None = None
+
+
+def _init_partition_worker(tile_paths, grid: Affine):
+    global _srcs, _grid
+    _srcs = [rasterio.open(p) for p in tile_paths]
+    _grid = grid
+
+
+def stitch_partition(part: Partition) -> np.ndarray:
+    """Merge only the tiles that touch this partition, over exactly its bounds."""
+    return merge_window(part.padded)
+
+
+def merge_window(window: Window) -> np.ndarray:
+    b = window_bounds(window, _grid)
+    hits = [s for s in _srcs if not disjoint_bounds(s.bounds, b)]
+    shape = (int(window.height), int(window.width))
+    if not hits:
+        nodata = _srcs[0].nodata
+        return np.full((_srcs[0].count, *shape), 0 if nodata is None else nodata,
+                       dtype=_srcs[0].dtypes[0])
+    mosaic, _ = merge(hits, bounds=b, res=(_grid.a, -_grid.e))
+    return mosaic[:, :shape[0], :shape[1]]
+
+
+def stitch_partitioned(tile_paths, out_path: Path, size: int, workers: int = 1,
+                       profiler: Profiler | None = None):
+    """`stitch`, but a partition at a time so the mosaic never sits in memory whole.
+
+    The output grid is the one `merge` would choose for the full set (union of
+    tile bounds at the first tile's resolution); each partition merges only the
+    tiles it overlaps and is written straight into its window.
+    """
+    profiler = profiler or Profiler("aef_tiles")
+    with rasterio.open(tile_paths[0]) as first:
+        profile = first.profile.copy()
+    expected = expected_grid(tile_paths)
+    width, height = expected["width"], expected["height"]
+    grid = Affine(*expected["transform"])
+    parts = plan_partitions(height, width, size)
+    profile.update(height=height, width=width, transform=grid, tiled=True,
+                   blockxsize=512, blockysize=512, BIGTIFF="IF_SAFER", **CREATION)
+    print(f"  {len(parts)} partitions of {size} px on {workers} workers")
+    tmp = out_path.with_suffix(".partial.tif")
+    with profiler.stage("merge_partitions", pixels=width * height, hot=True), \
+            rasterio.open(tmp, "w", **profile) as dst:
+        results = run_partitions(stitch_partition, parts, workers,
+                                 initializer=_init_partition_worker,
+                                 initargs=(tile_paths, grid))
+        mosaic_cores(dst, zip(parts, results))
+    tmp.replace(out_path)
+    return out_path
+
+
 def main():
     ap = argparse.ArgumentParser(description=__doc__.split("\n")[0])
     ap.add_argument("--aoi", help="AOI key from config.yaml; default aoi.current")
     ap.add_argument("--zip", dest="zip_path", help="override inputs/aef/aef_tiles.zip")
     ap.add_argument("--out", help="override the AOI config's sources.aef.input_file")
+    ap.add_argument("--partition-size", type=int, default=0,
+                    help="stitch in N x N pixel partitions; for AOIs too big for memory")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="processes for --partition-size and --delta")
+    ap.add_argument("--delta", action="store_true",
+                    help="re-merge only the areas whose tiles changed since the last stitch")
+    add_profile_args(ap)
     args = ap.parse_args()
 
     name, aoi_path, aoi_cfg = load_config(args.aoi)
@@ -77,8 +284,9 @@ def main():
     out.parent.mkdir(parents=True, exist_ok=True)
     print(f"=== AEF stitch - {name} ===")
 
-    with tempfile.TemporaryDirectory(prefix="aef_") as td:
-        with zipfile.ZipFile(zip_path) as z:
+    with Profiler.from_args("aef_tiles", args) as profiler, \
+            tempfile.TemporaryDirectory(prefix="aef_") as td:
+        with profiler.stage("extract"), zipfile.ZipFile(zip_path) as z:
             members = [m for m in z.namelist()
                        if m.lower().endswith((".tif", ".tiff"))
                        and "aef_" in Path(m).name
@@ -86,9 +294,28 @@ def main():
             if not members:
                 raise SystemExit("no aef_*.tif tiles inside the zip")
             z.extractall(td, members=members)
+        named = {m: Path(td) / m for m in sorted(members)}
         tiles = sorted(Path(td).rglob("*.tif")) + sorted(Path(td).rglob("*.tiff"))
-        print(f"found {len(tiles)} tiles; stitching -> {out}")
-        stitch(tiles, out)
+        with profiler.stage("hash_tiles"):
+            records = tile_records(named)
+        cells, reason = plan_delta(out, named, records) if args.delta else (None, "")
+        if args.delta and cells is None:
+            print(f"delta: {reason}; stitching everything")
+        if cells is not None:
+            print(f"delta: {reason}; re-merging {len(cells)} cells of "
+                  f"{DELTA_CELL} px -> {out}")
+            if cells:
+                with profiler.stage("stitch"):
+                    stitch_delta(tiles, out, cells, args.workers, profiler)
+        else:
+            print(f"found {len(tiles)} tiles; stitching -> {out}")
+            with profiler.stage("stitch"):
+                if args.partition_size:
+                    stitch_partitioned(tiles, out, args.partition_size, args.workers,
+                                       profiler)
+                else:
+                    stitch(tiles, out, profiler)
+        record_tiles(out, records, None if cells is None else [c.window for c in cells])
 
     with rasterio.open(out) as ds:
         print(f"wrote {out}  {ds.width}x{ds.height}, {ds.count} bands, "
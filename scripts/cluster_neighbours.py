@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Find clusters, at other k-levels or in other AOIs, that look like a given one.
+
+Labelling one k-level at a time is the slow part of building a land-cover map.
+Once a cluster is labelled, its mean AEF embedding says what it looks like;
+clusters elsewhere with nearly the same embedding are the first candidates
+for the same label.
+
+    build   stack every AOI's `cluster_stats/<k>.embeddings.npy` into one index
+    query   top matches for (AOI, k, cluster)
+
+Usage:
+    python scripts/precompute_cluster_stats.py --embeddings     # once per AOI
+    python scripts/cluster_neighbours.py build [--aoi A --aoi B]
+    python scripts/cluster_neighbours.py query k12 7 [--top 10] [--other-k-only]
+
+The index lands in the first AOI's `cluster_stats/embedding_index.npz`; the
+query server (`query_server.py`) serves the same lookups at
+`/k/<key>/clusters/<id>/similar`.
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from lib.config import load_config  # noqa: E402
+from lib.embedding_index import INDEX_FILENAME, EmbeddingIndex  # noqa: E402
+from precompute_cluster_stats import ClusterStatsConfig  # noqa: E402
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def stats_dir(aoi: str | None) -> tuple[str, Path]:
+    try:
+        config = load_config(ROOT, aoi)
+    except KeyError as e:
+        raise SystemExit(str(e).strip('"'))
+    return config["aoi_name"], ClusterStatsConfig.from_config(config, False).output_dir
+
+
+def cmd_build(args):
+    dirs = [stats_dir(a) for a in (args.aoi or [None])]
+    index = EmbeddingIndex.concat([EmbeddingIndex.from_stats_dir(d, name) for name, d in dirs])
+    out = Path(args.out) if args.out else dirs[0][1] / INDEX_FILENAME
+    index.save(out)
+    print(f"indexed {len(index)} clusters from {', '.join(n for n, _ in dirs)} -> {out}")
+
+
+def cmd_query(args):
+    name, d = stats_dir(args.aoi)
+    path = Path(args.index) if args.index else d / INDEX_FILENAME
+    if not path.exists():
+        raise SystemExit(f"no index at {path} - run `build` first")
+    index = EmbeddingIndex.load(path)
+    start = time.perf_counter()
+    try:
+        matches = index.similar(args.from_aoi or name, args.key, args.cluster,
+                                args.top, args.other_k_only)
+    except KeyError as e:
+        raise SystemExit(e.args[0])
+    ms = (time.perf_counter() - start) * 1e3
+    print(f"{len(matches)} nearest to {args.key} cluster {args.cluster} "
+          f"among {len(index)} ({ms:.1f} ms)")
+    for m in matches:
+        print(f"  {m['similarity']:.4f}  {m['aoi']:<20} {m['segmentation_key']:<6} "
+              f"cluster {m['cluster_id']}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    b = sub.add_parser("build", help="index the cluster embeddings of one or more AOIs")
+    b.add_argument("--aoi", action="append",
+                   help="AOI key from config.yaml; repeatable; default aoi.current")
+    b.add_argument("--out", help="override <first AOI>/cluster_stats/embedding_index.npz")
+    b.set_defaults(func=cmd_build)
+
+    q = sub.add_parser("query", help="clusters most similar to one cluster")
+    q.add_argument("key", help="segmentation key, e.g. k12")
+    q.add_argument("cluster", type=int)
+    q.add_argument("--aoi", help="AOI whose index to use; default aoi.current")
+    q.add_argument("--from-aoi", help="AOI the query cluster belongs to; default --aoi")
+    q.add_argument("--index", help="override the index path")
+    q.add_argument("--top", type=int, default=10)
+    q.add_argument("--other-k-only", action="store_true",
+                   help="skip matches from the query cluster's own k-level")
+    q.set_defaults(func=cmd_query)
+
+    args = ap.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
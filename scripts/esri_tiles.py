@@ -20,12 +20,35 @@ Usage:
     UV="uv run --no-project --with rasterio,numpy,pillow,pyyaml python"
     $UV scripts/esri_tiles.py download            # AOI + zoom from config.yaml
     $UV scripts/esri_tiles.py stitch
+    $UV scripts/esri_tiles.py stitch --profile-out trace.json   # per-stage timings
 
 Both read the same config chain as the JS did: root `config.yaml` -> `aoi.current`
 -> `aoi-paths` -> the AOI's own `config.yaml` (`sources.esri.zoom`, and either
 `bounds` or `shapefile_path`).
+
+With `sources.esri.overview_levels: N` (or `--overview-levels N`), `download`
+also fetches zooms z-1 .. z-N, and `stitch` builds the COG's overviews from
+that native imagery instead of letting GDAL downsample the full mosaic. Each
+level costs a quarter of the tiles of the one above, and the server's lower
+zooms are better than a bilinear average of the higher one. Each level is
+warped into its overview's grid on its own (nearest-neighbour when the target
+is EPSG:3857 and the grids line up, bilinear otherwise), and the COG driver
+copies them in as they are.
+
+The overview pyramid is therefore: levels 1/2 .. 1/2^N from zooms z-1 .. z-N,
+then, as far as GDAL would have gone on its own (until a level fits in one
+512 px tile), further halvings computed from the coarsest native level with
+cubic resampling, the COG driver's default. Without native levels, the COG
+driver builds the whole pyramid itself.
+
+Every successful `download` rewrites `inputs/esri/download.json` (zooms, bbox
+and tile counts), even when every tile was already on disk, so the pipeline
+runner can tell a run that checked the tile set from one that did nothing.
+Its content depends only on the tile set, so rewriting it does not make
+`stitch` stale.
 """
 import argparse
+import json
 import math
 import sys
 import time
@@ -38,11 +61,18 @@ from pathlib import Path
 TILE_URL = ("https://services.arcgisonline.com/arcgis/rest/services/"
             "World_Imagery/MapServer/tile/{z}/{y}/{x}")
 TS = 256
+DOWNLOAD_RECORD = "download.json"
 WEB_MERC_HALF = 20037508.342789244
 ROOT = Path(__file__).resolve().parent.parent
+# Intermediates are written once and read once, so favour speed over size;
+# only the final COG is DEFLATE.
+SCRATCH_COMPRESSION = dict(compress="ZSTD", zstd_level=1)
+# The COG driver's tile size; its own pyramids stop once a level fits in one.
+COG_BLOCK = 512
 
 sys.path.insert(0, str(Path(__file__).resolve().parent))
 from lib.config import load_config as _load_config  # noqa: E402
+from lib.profiling import Profiler, add_profile_args  # noqa: E402
 
 
 # --- the tile grid: defined once, used by both download and stitch -----------
@@ -112,6 +142,14 @@ def esri_zoom(aoi_cfg: dict) -> int:
         raise SystemExit("AOI config has no sources.esri.zoom")
 
 
+def overview_zooms(args, aoi_cfg: dict, z: int) -> list[int]:
+    """Lower zooms that become overviews, finest first; none unless configured."""
+    levels = args.overview_levels
+    if levels is None:
+        levels = (aoi_cfg.get("sources", {}).get("esri") or {}).get("overview_levels", 0)
+    return list(range(z - 1, max(z - 1 - levels, -1), -1))
+
+
 # --- download ----------------------------------------------------------------
 
 def fetch_one(x, y, z, out_dir: Path, retries=3):
@@ -142,80 +180,80 @@ def fetch_one(x, y, z, out_dir: Path, retries=3):
     return "gave up"
 
 
-def cmd_download(args):
+def cmd_download(args, profiler: Profiler):
     name, aoi_path, aoi_cfg = load_config(args.aoi)
     z = args.zoom or esri_zoom(aoi_cfg)
     w, s, e, n = aoi_bounds(aoi_path, aoi_cfg)
     out_dir = aoi_path / "inputs/esri"
     out_dir.mkdir(parents=True, exist_ok=True)
-    tiles = tiles_for_bbox(w, s, e, n, z)
-    print(f"AOI '{name}' z{z}: {len(tiles)} tiles -> {out_dir}")
+    tiles = [(x, y, zz) for zz in (z, *overview_zooms(args, aoi_cfg, z))
+             for x, y in tiles_for_bbox(w, s, e, n, zz)]
+    zooms = sorted({zz for _, _, zz in tiles}, reverse=True)
+    print(f"AOI '{name}' z{'/'.join(map(str, zooms))}: {len(tiles)} tiles -> {out_dir}")
 
     done = {"ok": 0, "skipped": 0}
     failed = []
-    with ThreadPoolExecutor(max_workers=args.workers) as pool:
-        futures = {pool.submit(fetch_one, x, y, z, out_dir): (x, y) for x, y in tiles}
-        for f, (x, y) in futures.items():
+    with profiler.stage("fetch") as st, ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(fetch_one, x, y, zz, out_dir): (x, y, zz) for x, y, zz in tiles}
+        for f, (x, y, zz) in futures.items():
             r = f.result()
             if r in done:
                 done[r] += 1
             else:
-                failed.append((x, y, r))
+                failed.append((x, y, zz, r))
             total = done["ok"] + done["skipped"] + len(failed)
             if total % 1000 == 0:
                 print(f"  {total}/{len(tiles)}")
+        st.extra.update(tiles=len(tiles), **done, failed=len(failed))
     print(f"downloaded {done['ok']}, already present {done['skipped']}, failed {len(failed)}")
-    for x, y, r in failed[:10]:
-        print(f"  FAILED {x}/{y}/{z}: {r}")
+    for x, y, zz, r in failed[:10]:
+        print(f"  FAILED {x}/{y}/{zz}: {r}")
     if failed:
         sys.exit(1)
+    record = {"zooms": zooms, "bbox": [w, s, e, n],
+              "tiles": {str(zz): sum(1 for t in tiles if t[2] == zz) for zz in zooms}}
+    tmp = out_dir / f"{DOWNLOAD_RECORD}.partial"
+    tmp.write_text(json.dumps(record, indent=2))
+    tmp.replace(out_dir / DOWNLOAD_RECORD)
 
 
 # --- stitch ------------------------------------------------------------------
 
-def cmd_stitch(args):
+def collect_tiles(tile_dir: Path, z: int) -> dict[tuple[int, int], Path]:
+    tiles = {}
+    for ext in ("png", "jpg"):
+        for p in tile_dir.glob(f"tile_{z}_*.{ext}"):
+            _, _, x, y = p.stem.split("_")
+            tiles[(int(x), int(y))] = p
+    return tiles
+
+
+def place_tiles(tiles: dict, z: int, path: Path, profiler: Profiler, stage: str):
+    """Lay one zoom's tiles into a Web Mercator GeoTIFF on that zoom's own grid."""
     import numpy as np
     import rasterio
     from PIL import Image
     from rasterio.crs import CRS
     from rasterio.transform import Affine
-    from rasterio.warp import Resampling, calculate_default_transform, reproject
     from rasterio.windows import Window
 
-    name, aoi_path, aoi_cfg = load_config(args.aoi)
-    z = args.zoom or esri_zoom(aoi_cfg)
-    tile_dir = aoi_path / "inputs/esri"
-    # Zoom-stamped by default. The JS wrote a single `stitched-esri.tif` whatever
-    # the zoom, so restitching at a new zoom silently replaced the old mosaic --
-    # and crops already cut from it could no longer be reproduced.
-    out = Path(args.out) if args.out else aoi_path / f"intermediates/esri_{name}_z{z}_cog.tif"
-    out.parent.mkdir(parents=True, exist_ok=True)
-
-    tiles = {}
-    for ext in ("png", "jpg"):
-        for p in tile_dir.glob(f"tile_{z}_*.{ext}"):
-            _, _, x, y = p.stem.split("_")
-            tiles[(int(x), int(y))] = p
-    if not tiles:
-        raise SystemExit(f"no z{z} tiles in {tile_dir} - run `download` first")
-
     xs = sorted({x for x, _ in tiles})
     ys = sorted({y for _, y in tiles})
     minx, miny = xs[0], ys[0]
     ncols, nrows = (xs[-1] - minx + 1) * TS, (ys[-1] - miny + 1) * TS
     res = tile_resolution(z)
     west, north = tile_origin_3857(minx, miny, z)
-    print(f"{len(tiles)} tiles -> {ncols} x {nrows} px @ {res:.4f} m/px")
+    print(f"z{z}: {len(tiles)} tiles -> {ncols} x {nrows} px @ {res:.4f} m/px")
 
-    merc = out.with_suffix(".merc.tif")
     bad = 0
-    with rasterio.open(merc, "w", driver="GTiff", height=nrows, width=ncols,
-                       count=3, dtype="uint8", crs=CRS.from_epsg(3857),
-                       transform=Affine(res, 0, west, 0, -res, north), tiled=True,
-                       blockxsize=512, blockysize=512, compress="DEFLATE",
-                       BIGTIFF="YES") as dst:
-        for i, ((tx, ty), path) in enumerate(sorted(tiles.items()), 1):
-            arr = np.array(Image.open(path).convert("RGB"))
+    with profiler.stage(stage, pixels=ncols * nrows, hot=True), \
+            rasterio.open(path, "w", driver="GTiff", height=nrows, width=ncols,
+                          count=3, dtype="uint8", crs=CRS.from_epsg(3857),
+                          transform=Affine(res, 0, west, 0, -res, north), tiled=True,
+                          blockxsize=512, blockysize=512, BIGTIFF="YES",
+                          **SCRATCH_COMPRESSION) as dst:
+        for i, ((tx, ty), tile) in enumerate(sorted(tiles.items()), 1):
+            arr = np.array(Image.open(tile).convert("RGB"))
             if arr.shape[:2] != (TS, TS):
                 bad += 1
                 continue
@@ -226,22 +264,141 @@ def cmd_stitch(args):
     if bad:
         print(f"  {bad} tiles skipped (unexpected size)")
 
+
+def reproject_bands(src, dst, resampling):
+    import rasterio
+    from rasterio.warp import reproject
+    for b in range(1, 4):
+        reproject(source=rasterio.band(src, b), destination=rasterio.band(dst, b),
+                  src_transform=src.transform, src_crs=src.crs,
+                  dst_transform=dst.transform, dst_crs=dst.crs,
+                  resampling=resampling)
+        print(f"  band {b} done")
+
+
+def overview_vrt(base: Path, overviews: list[Path], path: Path) -> Path:
+    """A VRT over `base` whose bands list `overviews` as their overview levels.
+
+    The COG driver copies a source's existing overviews rather than computing
+    its own, and a VRT is the one format that lets overviews live in files of
+    their own.
+    """
+    import rasterio
+    from xml.sax.saxutils import escape
+
+    with rasterio.open(base) as ds:
+        width, height, crs = ds.width, ds.height, ds.crs.to_wkt()
+        gt = ", ".join(repr(v) for v in ds.transform.to_gdal())
+        interps = [ci.name.capitalize() for ci in ds.colorinterp]
+    bands = []
+    for b, interp in enumerate(interps, 1):
+        ovrs = "".join(
+            f"<Overview><SourceFilename relativeToVRT=\"0\">{escape(str(o))}</SourceFilename>"
+            f"<SourceBand>{b}</SourceBand></Overview>" for o in overviews)
+        bands.append(
+            f"<VRTRasterBand dataType=\"Byte\" band=\"{b}\">"
+            f"<ColorInterp>{interp}</ColorInterp>"
+            f"<SimpleSource><SourceFilename relativeToVRT=\"0\">{escape(str(base))}"
+            f"</SourceFilename><SourceBand>{b}</SourceBand></SimpleSource>{ovrs}"
+            "</VRTRasterBand>")
+    path.write_text(
+        f"<VRTDataset rasterXSize=\"{width}\" rasterYSize=\"{height}\">"
+        f"<SRS>{escape(crs)}</SRS><GeoTransform>{gt}</GeoTransform>"
+        + "".join(bands) + "</VRTDataset>")
+    return path
+
+
+def cmd_stitch(args, profiler: Profiler):
+    import rasterio
+    import rasterio.shutil
+    from rasterio.crs import CRS
+    from rasterio.transform import Affine
+    from rasterio.warp import Resampling, calculate_default_transform
+
+    name, aoi_path, aoi_cfg = load_config(args.aoi)
+    z = args.zoom or esri_zoom(aoi_cfg)
+    tile_dir = aoi_path / "inputs/esri"
+    # Zoom-stamped by default. The JS wrote a single `stitched-esri.tif` whatever
+    # the zoom, so restitching at a new zoom silently replaced the old mosaic --
+    # and crops already cut from it could no longer be reproduced.
+    out = Path(args.out) if args.out else aoi_path / f"intermediates/esri_{name}_z{z}_cog.tif"
+    out.parent.mkdir(parents=True, exist_ok=True)
+
+    tiles = collect_tiles(tile_dir, z)
+    if not tiles:
+        raise SystemExit(f"no z{z} tiles in {tile_dir} - run `download` first")
+    lower = overview_zooms(args, aoi_cfg, z)
+    missing = [zz for zz in lower if not collect_tiles(tile_dir, zz)]
+    if missing:
+        raise SystemExit(f"no z{'/'.join(map(str, missing))} tiles in {tile_dir} - "
+                         f"run `download --overview-levels {len(lower)}` first")
+
+    merc = out.with_suffix(".merc.tif")
+    place_tiles(tiles, z, merc, profiler, "place_tiles")
+
     target = CRS.from_epsg(args.epsg)
     with rasterio.open(merc) as src:
         dt, dw, dh = calculate_default_transform(src.crs, target, src.width,
                                                  src.height, *src.bounds)
         print(f"reprojecting -> EPSG:{args.epsg}  {dw} x {dh}")
-        with rasterio.open(out, "w", driver="COG", height=dh, width=dw, count=3,
-                           dtype="uint8", crs=target, transform=dt,
-                           compress="DEFLATE", BIGTIFF="YES") as dst:
-            for b in range(1, 4):
-                reproject(source=rasterio.band(src, b),
-                          destination=rasterio.band(dst, b),
-                          src_transform=src.transform, src_crs=src.crs,
-                          dst_transform=dt, dst_crs=target,
-                          resampling=Resampling.bilinear)
-                print(f"  band {b} done")
+        # Without native overviews the COG driver builds its own, as before.
+        base = out.with_suffix(".base.tif") if lower else out
+        if lower:
+            driver = dict(driver="GTiff", tiled=True, blockxsize=512, blockysize=512,
+                          **SCRATCH_COMPRESSION)
+        else:
+            driver = dict(driver="COG", compress="DEFLATE")
+        with profiler.stage("reproject_cog", pixels=dw * dh, hot=True), \
+                rasterio.open(base, "w", height=dh, width=dw, count=3, dtype="uint8",
+                              crs=target, transform=dt, BIGTIFF="YES", **driver) as dst:
+            reproject_bands(src, dst, Resampling.bilinear)
     merc.unlink()
+
+    if lower:
+        def open_overview(level):
+            factor = 2 ** level
+            ow, oh = -(-dw // factor), -(-dh // factor)
+            ovr = out.with_suffix(f".ovr{level}.tif")
+            overviews.append(ovr)
+            return rasterio.open(ovr, "w", driver="GTiff", height=oh, width=ow, count=3,
+                                 dtype="uint8", crs=target,
+                                 transform=dt * Affine.scale(factor), tiled=True,
+                                 blockxsize=512, blockysize=512, BIGTIFF="YES",
+                                 **SCRATCH_COMPRESSION)
+
+        overviews = []
+        for level, zz in enumerate(lower, 1):
+            factor = 2 ** level
+            ovr_merc = out.with_suffix(f".z{zz}.merc.tif")
+            place_tiles(collect_tiles(tile_dir, zz), zz, ovr_merc, profiler,
+                        f"place_tiles_z{zz}")
+            ow, oh = -(-dw // factor), -(-dh // factor)
+            # Same CRS -> the zoom's pixels already sit on the overview grid.
+            resampling = Resampling.nearest if target == CRS.from_epsg(3857) \
+                else Resampling.bilinear
+            with rasterio.open(ovr_merc) as src, \
+                    profiler.stage(f"overview_z{zz}", pixels=ow * oh, hot=True), \
+                    open_overview(level) as dst:
+                reproject_bands(src, dst, resampling)
+            ovr_merc.unlink()
+            print(f"  overview 1/{factor} from z{zz}: {ow} x {oh}")
+        # Carry on halving the coarsest native level to where GDAL would stop.
+        level = len(lower)
+        while max(ow, oh) > COG_BLOCK:
+            level += 1
+            factor = 2 ** level
+            ow, oh = -(-dw // factor), -(-dh // factor)
+            with rasterio.open(overviews[-1]) as src, \
+                    profiler.stage(f"overview_1/{factor}", pixels=ow * oh), \
+                    open_overview(level) as dst:
+                reproject_bands(src, dst, Resampling.cubic)
+            print(f"  overview 1/{factor} from 1/{factor // 2}: {ow} x {oh}")
+        vrt = overview_vrt(base, overviews, out.with_suffix(".vrt"))
+        with profiler.stage("write_cog", pixels=dw * dh):
+            rasterio.shutil.copy(vrt, out, driver="COG", compress="DEFLATE",
+                                 BIGTIFF="YES", overviews="FORCE_USE_EXISTING")
+        for p in (vrt, base, *overviews):
+            p.unlink()
     print(f"wrote {out}  ({out.stat().st_size / 1e9:.2f} GB)")
 
 
@@ -253,6 +410,9 @@ def main():
     d.add_argument("--aoi", help="AOI key from config.yaml aoi-paths; default aoi.current")
     d.add_argument("--zoom", type=int, help="override sources.esri.zoom")
     d.add_argument("--workers", type=int, default=10)
+    d.add_argument("--overview-levels", type=int,
+                   help="also fetch this many lower zooms; default sources.esri.overview_levels")
+    add_profile_args(d)
     d.set_defaults(func=cmd_download)
 
     s = sub.add_parser("stitch", help="mosaic the downloaded tiles into a COG")
@@ -261,10 +421,15 @@ def main():
     s.add_argument("--epsg", type=int, default=4326,
                    help="target CRS; 4326 matches what the crop generators window in")
     s.add_argument("--out", help="override the zoom-stamped default path")
+    s.add_argument("--overview-levels", type=int,
+                   help="overviews from this many downloaded lower zooms; "
+                        "default sources.esri.overview_levels, 0 lets GDAL resample")
+    add_profile_args(s)
     s.set_defaults(func=cmd_stitch)
 
     args = ap.parse_args()
-    args.func(args)
+    with Profiler.from_args(f"esri_tiles.{args.cmd}", args) as profiler:
+        args.func(args, profiler)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""Export an AOI's labeled land cover as a COG, without the browser.
+
+Does what the viewer's "Export land cover" does (`CompositeController`'s
+composite, then `PixelClassifier` and `GeoTIFFExporter`), block by block:
+
+- Precedence matches `RasterTransform.aggregate` with the controller's
+  ordering: k-levels from highest k to lowest, and a pixel takes the label of
+  the first one whose cluster there is labeled. No labeled cluster -> 9999
+  (unlabeled); nodata in the highest-k raster -> -1.
+- Labels are truncated to `--level` of the hierarchy, as the legend's level
+  selector does.
+- Outputs are the same three files as the viewer's zip: `land-cover_cog.tif`,
+  `pixel-mapping.json` and `land-cover-colors.json`.
+
+Each k-level's labels become a lookup table from cluster ID to class ID, so a
+block is composited with one fancy-index and mask per k rather than a
+per-pixel search. Windows run in worker processes; the finished raster is
+copied to a COG with nearest-neighbour overviews.
+
+Two differences from the viewer, both deliberate:
+
+- Class IDs number every labeled class (sorted by path), not only those that
+  win at least one pixel, so the same labels file always yields the same IDs.
+- Output is always int16. The viewer picks int8 when there are fewer than 127
+  classes, which cannot hold the 9999 unlabeled value.
+
+User-drawn (synthetic) regions exist only in the browser session; their
+labels are skipped with a warning.
+
+Usage:
+    python scripts/export_land_cover.py [--aoi auroville-24-10 ...] [--all-aois]
+        [--labels cluster-labels.json] [--level 2] [--workers 4]
+
+Labels default to the AOI's `files.cluster_labels` (else
+`inputs/cluster_labels.json`): the file the viewer's "Export labels" writes.
+"""
+
+import argparse
+import json
+import re
+import sys
+import traceback
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+
+sys.path.insert(0, str(Path(__file__).parent))
+from lib.config import get_current_segmentation, load_config, resolve_aoi_path
+from lib.partition import Partition, plan_partitions, run_partitions
+from lib.profiling import Profiler, add_profile_args
+
+ROOT = Path(__file__).resolve().parent.parent
+NODATA = -1
+UNLABELED = 9999
+SYNTHETIC_KEY = "synthetic_seg"
+
+
+@dataclass(frozen=True)
+class LandCoverExportConfig:
+    aoi_name: str
+    segmentation_dir: Path
+    manifest_path: Path
+    labels_path: Path
+    output_dir: Path
+    verbose: bool
+
+    @classmethod
+    def from_config(
+        cls, config: Dict[str, Any], labels: str | None, verbose: bool
+    ) -> "LandCoverExportConfig":
+        aoi_path = config["aoi_path"]
+        aoi_config = config["aoi_config"]
+        _, seg_config = get_current_segmentation(aoi_config)
+        files_config = aoi_config.get("files", {})
+        intermediates_rel = files_config.get("intermediates_dir", "intermediates")
+        output_subdir = seg_config.get("output_subdir", "clusters")
+        segmentation_dir = resolve_aoi_path(
+            aoi_path, f"{intermediates_rel}/{output_subdir}"
+        )
+        labels_rel = files_config.get("cluster_labels", "inputs/cluster_labels.json")
+        return cls(
+            aoi_name=config["aoi_name"],
+            segmentation_dir=segmentation_dir,
+            manifest_path=segmentation_dir / "manifest.json",
+            labels_path=Path(labels) if labels else resolve_aoi_path(aoi_path, labels_rel),
+            output_dir=resolve_aoi_path(aoi_path, f"{intermediates_rel}/land_cover"),
+            verbose=verbose,
+        )
+
+    def validate(self) -> None:
+        if not self.manifest_path.exists():
+            raise FileNotFoundError(f"Manifest not found: {self.manifest_path}")
+        if not self.labels_path.exists():
+            raise FileNotFoundError(f"Labels not found: {self.labels_path}")
+
+
+def k_value(seg_key: str) -> int:
+    match = re.search(r"k(\d+)", seg_key)
+    return int(match.group(1)) if match else -1
+
+
+def truncate_path(path: str, level: int) -> str:
+    return ".".join(path.split(".")[:level])
+
+
+def class_table(
+    labels: Dict[str, Dict[str, str]], seg_keys: List[str], level: int
+) -> Tuple[Dict[str, str], Dict[str, np.ndarray]]:
+    """Pixel mapping (class ID -> path) and a cluster -> class lookup table per k.
+
+    A table has one slot per cluster ID plus a leading slot for ID -1 and a
+    trailing catch-all, both unlabeled (-1), so any int16 block indexes it
+    after `clip(ids, -1, n) + 1`.
+    """
+    paths = sorted(
+        {
+            truncate_path(path, level)
+            for key in seg_keys
+            for path in labels.get(key, {}).values()
+            if path and path != "unlabeled"
+        }
+    )
+    class_ids = {path: i for i, path in enumerate(paths)}
+    luts = {}
+    for key in seg_keys:
+        cluster_labels = {
+            int(cid): class_ids[truncate_path(path, level)]
+            for cid, path in labels.get(key, {}).items()
+            if path and path != "unlabeled"
+        }
+        if not cluster_labels:
+            continue
+        lut = np.full(max(cluster_labels) + 3, -1, dtype=np.int16)
+        for cid, class_id in cluster_labels.items():
+            if cid >= 0:
+                lut[cid + 1] = class_id
+        luts[key] = lut
+    pixel_mapping = {str(i): path for i, path in enumerate(paths)}
+    pixel_mapping[str(UNLABELED)] = "unlabeled"
+    return pixel_mapping, luts
+
+
+def color_for_path(path: str, colors: Dict[str, str]) -> str:
+    """The path's colour, else its nearest ancestor's (`getColorForPath`)."""
+    parts = path.split(".")
+    while parts:
+        color = colors.get(".".join(parts))
+        if color:
+            return color
+        parts.pop()
+    raise KeyError(f"No color mapping found for path: {path}")
+
+
+def color_mapping(pixel_mapping: Dict[str, str], colors: Dict[str, str]) -> Dict[str, Any]:
+    mapping: Dict[str, Any] = {str(NODATA): "#000000", str(UNLABELED): None}
+    for class_id, path in pixel_mapping.items():
+        if path != "unlabeled":
+            mapping[class_id] = color_for_path(path, colors)
+    return mapping
+
+
+_worker_layers: List[Tuple[Path, np.ndarray | None]] = []
+
+
+def _init_export_worker(layers: List[Tuple[Path, np.ndarray | None]]) -> None:
+    global _worker_layers
+    _worker_layers = layers
+
+
+def composite_partition(part: Partition) -> np.ndarray:
+    """Land-cover class IDs for one window; layers are in precedence order."""
+    out = None
+    for seg_path, lut in _worker_layers:
+        with rasterio.open(seg_path) as src:
+            ids = src.read(1, window=part.window)
+            nodata = NODATA if src.nodata is None else int(src.nodata)
+        if out is None:
+            # The highest-k raster decides nodata, labeled or not.
+            out = np.where(ids == nodata, NODATA, UNLABELED).astype(np.int16)
+        if lut is None:
+            continue
+        classes = lut[np.clip(ids, -1, len(lut) - 2) + 1]
+        take = (out == UNLABELED) & (classes >= 0)
+        out[take] = classes[take]
+    return out
+
+
+def export_aoi(
+    config: LandCoverExportConfig,
+    colors: Dict[str, str],
+    level: int,
+    block_size: int,
+    workers: int,
+    profiler: Profiler,
+) -> Path:
+    config.validate()
+    with open(config.manifest_path) as f:
+        manifest = json.load(f)
+    with open(config.labels_path) as f:
+        labels = json.load(f)
+    if SYNTHETIC_KEY in labels and labels[SYNTHETIC_KEY]:
+        print(
+            f"   ⚠️  skipping {len(labels[SYNTHETIC_KEY])} synthetic-region labels: "
+            "their pixels exist only in the viewer session"
+        )
+    seg_paths = sorted(
+        (
+            (key, config.segmentation_dir / filename)
+            for key, filename in zip(manifest["segmentation_keys"], manifest["files"])
+        ),
+        key=lambda kp: -k_value(kp[0]),
+    )
+    seg_keys = [key for key, _ in seg_paths]
+    pixel_mapping, luts = class_table(labels, seg_keys, level)
+    if not luts:
+        raise ValueError(f"No labels in {config.labels_path} for {', '.join(seg_keys)}")
+    layers = [(path, luts.get(key)) for key, path in seg_paths]
+
+    with rasterio.open(seg_paths[0][1]) as src:
+        profile = src.profile.copy()
+        height, width = src.height, src.width
+    parts = plan_partitions(height, width, block_size)
+    if config.verbose:
+        print(f"🚀 Exporting land cover - {config.aoi_name}")
+        print(f"   Labels: {config.labels_path}")
+        print(f"   Precedence: {' > '.join(k for k in seg_keys if k in luts)}")
+        print(f"   Classes at level {level}: {len(pixel_mapping) - 1}")
+        print(f"   Windows: {len(parts)} on {workers} workers")
+
+    config.output_dir.mkdir(parents=True, exist_ok=True)
+    out_path = config.output_dir / "land-cover_cog.tif"
+    tmp = config.output_dir / "land-cover.partial.tif"
+    profile.update(
+        driver="GTiff", dtype="int16", count=1, nodata=NODATA, tiled=True,
+        blockxsize=512, blockysize=512, compress="ZSTD", BIGTIFF="IF_SAFER",
+    )
+    profile.pop("interleave", None)
+    class_counts = np.zeros(len(pixel_mapping) - 1, dtype=np.int64)
+    unlabeled = 0
+    with profiler.stage("composite", pixels=height * width * len(luts), hot=True), \
+            rasterio.open(tmp, "w", **profile) as dst:
+        results = run_partitions(
+            composite_partition,
+            parts,
+            workers,
+            initializer=_init_export_worker,
+            initargs=(layers,),
+        )
+        for part, block in zip(parts, results):
+            dst.write(block, 1, window=part.window)
+            labeled = block[(block >= 0) & (block != UNLABELED)]
+            class_counts += np.bincount(labeled, minlength=len(class_counts))
+            unlabeled += int((block == UNLABELED).sum())
+
+    # The COG driver only builds from a finished dataset; it writes to a
+    # sibling path first so a failed copy never replaces a good export.
+    cog_tmp = config.output_dir / "land-cover_cog.partial.tif"
+    with profiler.stage("write_cog", pixels=height * width):
+        rasterio.shutil.copy(
+            tmp, cog_tmp, driver="COG", compress="DEFLATE", predictor=2,
+            overview_resampling="NEAREST", num_threads="ALL_CPUS", BIGTIFF="IF_SAFER",
+        )
+        cog_tmp.replace(out_path)
+        tmp.unlink()
+
+    with open(config.output_dir / "pixel-mapping.json", "w") as f:
+        json.dump(pixel_mapping, f, indent=2)
+    with open(config.output_dir / "land-cover-colors.json", "w") as f:
+        json.dump(color_mapping(pixel_mapping, colors), f, indent=2)
+
+    if config.verbose:
+        total = int(class_counts.sum()) + unlabeled
+        for class_id, count in enumerate(class_counts):
+            if count:
+                print(f"   {class_id:>4}  {pixel_mapping[str(class_id)]:<45} "
+                      f"{count / max(total, 1):6.1%}")
+        print(f"   {UNLABELED:>4}  {'unlabeled':<45} {unlabeled / max(total, 1):6.1%}")
+        print(f"✅ {out_path} ({out_path.stat().st_size / 1e6:.1f} MB)")
+    return out_path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export labeled land cover as a COG, composited across k-levels"
+    )
+    parser.add_argument(
+        "--aoi", action="append", help="AOI key from config.yaml; repeatable; default aoi.current"
+    )
+    parser.add_argument(
+        "--all-aois", action="store_true",
+        help="Every AOI in config.yaml that is set up here and has labels",
+    )
+    parser.add_argument("--labels", help="Labels JSON; only with a single AOI")
+    parser.add_argument(
+        "--level", type=int, default=1, choices=range(1, 5), help="Hierarchy level to export"
+    )
+    parser.add_argument(
+        "--colors", default=str(ROOT / "app/hierarchy-colors.json"),
+        help="Classification path -> hex colour",
+    )
+    parser.add_argument(
+        "--block-size", type=int, default=1024, help="Window edge in pixels per pass"
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Processes over windows")
+    parser.add_argument(
+        "--verbose", action="store_true", default=True, help="Print detailed progress"
+    )
+    add_profile_args(parser)
+    args = parser.parse_args()
+
+    aoi_paths = {}
+    if args.all_aois:
+        aoi_paths = load_config(ROOT)["global_config"]["aoi-paths"]
+        aois = list(aoi_paths)
+    else:
+        aois = args.aoi or [None]
+    if args.labels and len(aois) > 1:
+        parser.error("--labels needs exactly one AOI")
+    with open(args.colors) as f:
+        colors = json.load(f)
+
+    failed = []
+    profiler = Profiler.from_args("export_land_cover", args)
+    try:
+        for aoi in aois:
+            # Listed AOIs not set up on this machine are skipped like unlabelled ones.
+            if args.all_aois and not (ROOT / aoi_paths[aoi] / "config.yaml").exists():
+                print(f"⏭  {aoi}: no AOI config at {ROOT / aoi_paths[aoi]}")
+                continue
+            try:
+                config = LandCoverExportConfig.from_config(
+                    load_config(ROOT, aoi), args.labels, args.verbose
+                )
+                if args.all_aois and not config.labels_path.exists():
+                    print(f"⏭  {config.aoi_name}: no labels at {config.labels_path}")
+                    continue
+                with profiler.stage(f"export:{config.aoi_name}"):
+                    export_aoi(
+                        config, colors, args.level, args.block_size, args.workers, profiler
+                    )
+            except Exception as e:
+                print(f"❌ Error ({aoi or 'current AOI'}): {e}")
+                if args.verbose:
+                    traceback.print_exc()
+                failed.append(aoi)
+    finally:
+        profiler.close()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
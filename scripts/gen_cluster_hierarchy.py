@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 
+import argparse
 import sys
 from pathlib import Path
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 import traceback
 from typing import List, Dict, Any
 import numpy as np
@@ -14,6 +15,7 @@ from lib.config import (
     get_current_segmentation,
     resolve_aoi_path,
 )
+from lib.profiling import Profiler, add_profile_args
 
 try:
     from alpha_bhu.data import load_aef_embeddings, reshape_for_clustering
@@ -69,7 +71,10 @@ class ClusterConfig:
 
 
 def generate_hierarchical_clusters(
-    config: ClusterConfig, embeddings_flat: np.ndarray, metadata: Dict[str, Any]
+    config: ClusterConfig,
+    embeddings_flat: np.ndarray,
+    metadata: Dict[str, Any],
+    profiler: Profiler,
 ):
     if config.verbose:
         print("\n🚀 Starting Hierarchical Clustering Generator")
@@ -81,27 +86,31 @@ def generate_hierarchical_clusters(
     if config.output_dir.exists() and not config.overwrite_existing:
         print(f"⌛ Output directory exists, skipping: {config.output_dir}")
         return
-    segset = SegSet.from_embeddings(
-        embeddings_flat, metadata["shape"]
-    ).with_kmeans_range(
-        config.k_values,
-        sample_fraction=config.sample_fraction,
-        random_state=config.random_seed,
-        verbose=config.verbose,
-    )
-    color_mapper, color_meta = create_hierarchical_color_mapper(
-        segset,
-        n_color_families=config.n_color_families,
-        random_state=config.random_seed,
-        verbose=config.verbose,
-    )
-    results = export_animation_geotiffs(
-        segset,
-        color_mapper,
-        metadata,
-        config.output_dir,
-        verbose=config.verbose,
-    )
+    n_pixels = len(embeddings_flat)
+    with profiler.stage("kmeans", pixels=n_pixels * len(config.k_values), hot=True):
+        segset = SegSet.from_embeddings(
+            embeddings_flat, metadata["shape"]
+        ).with_kmeans_range(
+            config.k_values,
+            sample_fraction=config.sample_fraction,
+            random_state=config.random_seed,
+            verbose=config.verbose,
+        )
+    with profiler.stage("color_mapping"):
+        color_mapper, color_meta = create_hierarchical_color_mapper(
+            segset,
+            n_color_families=config.n_color_families,
+            random_state=config.random_seed,
+            verbose=config.verbose,
+        )
+    with profiler.stage("export_geotiffs", pixels=n_pixels * len(config.k_values)):
+        results = export_animation_geotiffs(
+            segset,
+            color_mapper,
+            metadata,
+            config.output_dir,
+            verbose=config.verbose,
+        )
     if config.verbose:
         print("✅ Hierarchical clustering generation complete!")
         print(f"📁 {len(results['exported_files'])} cluster rasters")
@@ -110,10 +119,22 @@ def generate_hierarchical_clusters(
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Generate hierarchical cluster rasters")
+    parser.add_argument("--aoi", help="AOI key from config.yaml; default aoi.current")
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Regenerate even if overwrite_existing is false and outputs exist",
+    )
+    add_profile_args(parser)
+    args = parser.parse_args()
     project_root = Path(__file__).parent.parent
+    profiler = Profiler.from_args("gen_cluster_hierarchy", args)
     try:
-        config = load_config(project_root)
+        config = load_config(project_root, args.aoi)
         cluster_config = ClusterConfig.from_config(config)
+        if args.overwrite:
+            cluster_config = replace(cluster_config, overwrite_existing=True)
         verbose = cluster_config.verbose
         cluster_config.validate()
         if verbose:
@@ -121,14 +142,18 @@ def main():
             print(f"Input file: {cluster_config.aef_file.resolve()}")
         if verbose:
             print(f"\n📊 Loading AEF embeddings from {cluster_config.aef_file.name}...")
-        embeddings, metadata = load_aef_embeddings(cluster_config.aef_file)
-        embeddings_flat = reshape_for_clustering(embeddings)
+        with profiler.stage("load_aef", hot=True) as st:
+            embeddings, metadata = load_aef_embeddings(cluster_config.aef_file)
+            embeddings_flat = reshape_for_clustering(embeddings)
+            st.add_pixels(len(embeddings_flat))
         if verbose:
             valid_pixels = (~np.isnan(embeddings_flat).any(axis=1)).sum()
             print(
                 f"✓ Loaded. Valid pixels: {valid_pixels:,} / {len(embeddings_flat):,}"
             )
-        generate_hierarchical_clusters(cluster_config, embeddings_flat, metadata)
+        generate_hierarchical_clusters(
+            cluster_config, embeddings_flat, metadata, profiler
+        )
         if verbose:
             print("\n🎉 Hierarchical clustering generation complete!")
             print("\nOutput directory:")
@@ -143,6 +168,8 @@ def main():
         if cluster_config.verbose if "cluster_config" in locals() else True:
             traceback.print_exc()
         sys.exit(1)
+    finally:
+        profiler.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,125 @@
+"""Nearest-neighbour lookup over per-(AOI, k, cluster) mean AEF embeddings.
+
+`precompute_cluster_stats.py --embeddings` leaves one `<k>.embeddings.npy`
+per k-level, row-aligned with the `cluster_id` column of `<k>.json`. This
+module stacks those rows — across k-levels, and across AOIs if asked — into
+one L2-normalised matrix, so "which clusters look like this labelled one" is
+a single matrix-vector product.
+
+Search is exact, in batches. A full k-sweep is a few thousand rows of 64
+floats; even a dozen AOIs stay under a million multiply-adds per query, well
+inside a millisecond budget, so an approximate structure would add recall
+loss for no measurable gain.
+"""
+import json
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+INDEX_FILENAME = "embedding_index.npz"
+
+
+@dataclass(frozen=True)
+class EmbeddingIndex:
+    vectors: np.ndarray  # (n, bands) float32, unit rows
+    aoi: np.ndarray  # (n,) str
+    seg_key: np.ndarray  # (n,) str
+    cluster_id: np.ndarray  # (n,) int64
+
+    def __len__(self) -> int:
+        return len(self.cluster_id)
+
+    @staticmethod
+    def from_stats_dir(stats_dir: Path, aoi: str) -> "EmbeddingIndex":
+        vectors, seg_keys, cluster_ids = [], [], []
+        for stats_path in sorted(stats_dir.glob("*.json")):
+            with open(stats_path) as f:
+                stats = json.load(f)
+            if not stats.get("embedding_file"):
+                continue
+            emb = np.load(stats_dir / stats["embedding_file"])
+            ids = np.asarray(stats["columns"]["cluster_id"], dtype=np.int64)
+            keep = ~np.isnan(emb).any(axis=1)
+            vectors.append(emb[keep])
+            cluster_ids.append(ids[keep])
+            seg_keys.append(np.full(keep.sum(), stats["segmentation_key"]))
+        if not vectors:
+            raise FileNotFoundError(
+                f"no cluster embeddings in {stats_dir}; "
+                "run precompute_cluster_stats.py --embeddings"
+            )
+        stacked = np.concatenate(vectors).astype(np.float32)
+        norms = np.linalg.norm(stacked, axis=1, keepdims=True)
+        return EmbeddingIndex(
+            vectors=stacked / np.maximum(norms, 1e-12),
+            aoi=np.full(len(stacked), aoi),
+            seg_key=np.concatenate(seg_keys),
+            cluster_id=np.concatenate(cluster_ids),
+        )
+
+    @staticmethod
+    def concat(indexes: list["EmbeddingIndex"]) -> "EmbeddingIndex":
+        return EmbeddingIndex(
+            vectors=np.concatenate([i.vectors for i in indexes]),
+            aoi=np.concatenate([i.aoi for i in indexes]),
+            seg_key=np.concatenate([i.seg_key for i in indexes]),
+            cluster_id=np.concatenate([i.cluster_id for i in indexes]),
+        )
+
+    @staticmethod
+    def load(path: Path) -> "EmbeddingIndex":
+        with np.load(path) as z:
+            return EmbeddingIndex(z["vectors"], z["aoi"], z["seg_key"], z["cluster_id"])
+
+    def save(self, path: Path) -> Path:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(path, vectors=self.vectors, aoi=self.aoi, seg_key=self.seg_key,
+                 cluster_id=self.cluster_id)
+        return path
+
+    def row(self, aoi: str, seg_key: str, cluster_id: int) -> int:
+        hits = np.flatnonzero((self.aoi == aoi) & (self.seg_key == seg_key)
+                              & (self.cluster_id == cluster_id))
+        if not len(hits):
+            raise KeyError(f"no embedding for {aoi} {seg_key} cluster {cluster_id}")
+        return int(hits[0])
+
+    def search(self, queries: np.ndarray, top: int = 10, batch: int = 4096,
+               exclude: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """Cosine top-`top` rows for each query vector: (indices, similarities).
+
+        Rows where the (n,) mask `exclude` is set are never returned.
+        """
+        queries = np.atleast_2d(queries).astype(np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        top = min(top, len(self) - (int(exclude.sum()) if exclude is not None else 0))
+        if top <= 0:
+            empty = np.empty((len(queries), 0))
+            return empty.astype(np.int64), empty.astype(np.float32)
+        idx, sim = [], []
+        for start in range(0, len(queries), batch):
+            scores = queries[start:start + batch] @ self.vectors.T
+            if exclude is not None:
+                scores[:, exclude] = -np.inf
+            best = np.argpartition(-scores, top - 1, axis=1)[:, :top]
+            best_scores = np.take_along_axis(scores, best, axis=1)
+            order = np.argsort(-best_scores, axis=1)
+            idx.append(np.take_along_axis(best, order, axis=1))
+            sim.append(np.take_along_axis(best_scores, order, axis=1))
+        return np.concatenate(idx), np.concatenate(sim)
+
+    def similar(self, aoi: str, seg_key: str, cluster_id: int, top: int = 10,
+                other_k_only: bool = False) -> list[dict]:
+        """Clusters most like one indexed cluster, itself excluded."""
+        query = self.row(aoi, seg_key, cluster_id)
+        exclude = np.zeros(len(self), dtype=bool)
+        exclude[query] = True
+        if other_k_only:
+            exclude |= (self.aoi == aoi) & (self.seg_key == seg_key)
+        idx, sim = self.search(self.vectors[query], top, exclude=exclude)
+        return [
+            {"aoi": str(self.aoi[i]), "segmentation_key": str(self.seg_key[i]),
+             "cluster_id": int(self.cluster_id[i]), "similarity": round(float(s), 4)}
+            for i, s in zip(idx[0], sim[0])
+        ]
@@ -0,0 +1,175 @@
+"""Reference-label features clipped to an AOI, spatially indexed and cached.
+
+The reference shapefiles are state-wide; an AOI raster covers a sliver of
+them. `load_features` asks fiona only for features whose bbox meets the
+raster's bounds, optionally simplifies them to pixel resolution, and keeps
+them as shapely geometries with an STRtree for per-window lookups.
+
+Feature IDs are the shapefile's record index + 1, whatever was filtered out.
+The viewer addresses intersections as `featureIndex + 1` over the full
+shapefile, so IDs must not be renumbered after clipping.
+
+The clipped set is cached as WKB next to the intersection outputs, keyed by
+the shapefile's files (name, size, mtime), the bounds and the tolerance, so
+later runs skip fiona entirely.
+"""
+import hashlib
+import json
+from dataclasses import dataclass
+from functools import cached_property
+from pathlib import Path
+from typing import Any, Iterator
+
+import fiona
+import numpy as np
+import shapely
+from fiona.crs import CRS
+from rasterio.warp import transform_bounds
+from shapely.geometry import shape
+from shapely.strtree import STRtree
+
+Bounds = tuple[float, float, float, float]
+
+
+@dataclass(frozen=True)
+class FeatureSet:
+    ids: np.ndarray
+    geometries: np.ndarray
+    properties: list[dict[str, Any]]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @cached_property
+    def tree(self) -> STRtree:
+        return STRtree(self.geometries)
+
+    def __getstate__(self) -> dict[str, Any]:
+        # Partition workers receive the set by pickle; each builds its own tree.
+        return {k: v for k, v in self.__dict__.items() if k != "tree"}
+
+    @property
+    def max_id(self) -> int:
+        return int(self.ids.max()) if len(self.ids) else 0
+
+    @property
+    def raster_dtype(self) -> type[np.unsignedinteger]:
+        """Narrowest raster dtype that holds every ID; parcel layers exceed uint16."""
+        return np.uint16 if self.max_id <= np.iinfo(np.uint16).max else np.uint32
+
+    def shapes(self) -> Iterator[tuple[shapely.Geometry, int]]:
+        """(geometry, feature_id) pairs, as `rasterio.features.rasterize` takes them."""
+        return zip(self.geometries, self.ids.tolist())
+
+    def within(self, bounds: Bounds) -> "FeatureSet":
+        """Features whose envelope meets `bounds`, in ID order."""
+        idx = np.sort(self.tree.query(shapely.box(*bounds)))
+        return FeatureSet(self.ids[idx], self.geometries[idx],
+                          [self.properties[i] for i in idx])
+
+    def simplified(self, tolerance: float) -> "FeatureSet":
+        return FeatureSet(
+            self.ids,
+            shapely.simplify(self.geometries, tolerance, preserve_topology=True),
+            self.properties,
+        )
+
+    def property_map(self) -> dict[str, dict[str, Any]]:
+        return {str(fid): props for fid, props in zip(self.ids.tolist(), self.properties)}
+
+
+def shapefile_uri(path: Path) -> str:
+    return f"zip://{path}" if path.suffix == ".zip" else str(path)
+
+
+def source_files(path: Path) -> list[Path]:
+    """A .shp is only its geometry; attributes and CRS live in sibling files."""
+    return sorted(path.parent.glob(f"{path.stem}.*")) if path.suffix == ".shp" else [path]
+
+
+def read_features(path: Path, bounds: Bounds | None = None,
+                  bounds_crs: Any = None, verbose: bool = False) -> FeatureSet:
+    """Read features through fiona, bbox-filtered when `bounds` is given."""
+    with fiona.open(shapefile_uri(path)) as src:
+        if verbose:
+            print(f"📂 Loading shapefile: {src.name}")
+            print(f"   CRS: {src.crs}")
+            print(f"   Features: {len(src)}")
+        if bounds is not None and bounds_crs is not None and src.crs \
+                and CRS.from_user_input(bounds_crs) != src.crs:
+            bounds = transform_bounds(bounds_crs, src.crs, *bounds)
+        records = src.filter(bbox=bounds) if bounds is not None else src
+        ids, geometries, properties = [], [], []
+        for position, feature in enumerate(records):
+            # fiona's id is the record index for shapefiles; fall back to
+            # position only when a driver gives something non-numeric.
+            fid = int(feature.id) if str(feature.id).isdigit() else position
+            ids.append(fid + 1)
+            geometries.append(shape(feature["geometry"]) if feature["geometry"]
+                              else shapely.Polygon())
+            properties.append(dict(feature.get("properties", {})))
+    if verbose and bounds is not None:
+        print(f"   Within raster bounds: {len(ids)}")
+    return FeatureSet(np.asarray(ids, dtype=np.int64),
+                      np.asarray(geometries, dtype=object), properties)
+
+
+def cache_key(path: Path, bounds: Bounds | None, tolerance: float) -> str:
+    h = hashlib.sha256()
+    for p in source_files(path):
+        st = p.stat()
+        h.update(f"{p.name}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    h.update(json.dumps([bounds and [round(b, 9) for b in bounds], tolerance]).encode())
+    return h.hexdigest()
+
+
+def save_cache(cache_path: Path, key: str, features: FeatureSet) -> None:
+    wkb = shapely.to_wkb(features.geometries)
+    offsets = np.cumsum([0, *(len(b) for b in wkb)], dtype=np.int64)
+    tmp = cache_path.with_suffix(".partial.npz")
+    np.savez(
+        tmp,
+        key=np.frombuffer(key.encode(), dtype=np.uint8),
+        ids=features.ids,
+        wkb=np.frombuffer(b"".join(wkb), dtype=np.uint8),
+        offsets=offsets,
+        properties=np.frombuffer(json.dumps(features.properties, default=str).encode(),
+                                 dtype=np.uint8),
+    )
+    tmp.replace(cache_path)
+
+
+def read_cache(cache_path: Path, key: str) -> FeatureSet | None:
+    if not cache_path.exists():
+        return None
+    with np.load(cache_path) as z:
+        if z["key"].tobytes().decode() != key:
+            return None
+        blob, offsets = z["wkb"].tobytes(), z["offsets"]
+        wkb = [blob[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+        return FeatureSet(z["ids"], shapely.from_wkb(wkb),
+                          json.loads(z["properties"].tobytes()))
+
+
+def load_features(
+    path: Path,
+    bounds: Bounds | None = None,
+    bounds_crs: Any = None,
+    tolerance: float = 0.0,
+    cache_path: Path | None = None,
+    verbose: bool = False,
+) -> FeatureSet:
+    """Clipped (and optionally simplified) features, from cache when still valid."""
+    key = cache_key(path, bounds, tolerance)
+    cached = read_cache(cache_path, key) if cache_path else None
+    if cached is not None:
+        if verbose:
+            print(f"📂 {len(cached)} features from cache {cache_path.name}")
+        return cached
+    features = read_features(path, bounds, bounds_crs, verbose)
+    if tolerance:
+        features = features.simplified(tolerance)
+    if cache_path:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        save_cache(cache_path, key, features)
+    return features
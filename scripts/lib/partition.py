@@ -0,0 +1,161 @@
+"""Split an AOI raster grid into overlapping processing tiles and merge results back.
+
+Every script used to assume the AOI fits in memory as one raster. That holds
+for the 3.5K AOI and fails long before `india-24-1000`. A `Partition` is one
+cell of a regular grid over the reference raster:
+
+- `window` is the cell's *core*: the pixels it owns. Cores tile the raster
+  exactly, with no gaps and no double counting.
+- `padded` is the core grown by `overlap` pixels on each side (clipped to the
+  raster), for stages whose output at a pixel depends on its neighbours.
+  Results are always cropped back to the core before merging.
+
+IDs are `r<row>_c<col>` in grid order, so the same raster, tile size and
+overlap always produce the same IDs; a job list written on one machine names
+the same ground on another.
+
+Merging is stage-specific but has two shapes: rasters are mosaicked core by
+core (`mosaic_cores`), contingency counts are summed (`sum_pair_counts`).
+"""
+import json
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, Sequence
+
+import numpy as np
+from rasterio.windows import Window
+
+
+@dataclass(frozen=True)
+class Partition:
+    id: str
+    row: int
+    col: int
+    window: Window
+    padded: Window
+
+    @property
+    def core_in_padded(self) -> Window:
+        """The core, in the padded window's own pixel coordinates."""
+        return Window(self.window.col_off - self.padded.col_off,
+                      self.window.row_off - self.padded.row_off,
+                      self.window.width, self.window.height)
+
+    @property
+    def pixels(self) -> int:
+        return int(self.window.width * self.window.height)
+
+    def crop_core(self, arr: np.ndarray) -> np.ndarray:
+        """Slice a result computed over `padded` down to the core (last two axes)."""
+        core = self.core_in_padded
+        return arr[..., core.row_off:core.row_off + core.height,
+                   core.col_off:core.col_off + core.width]
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "row": self.row,
+            "col": self.col,
+            "window": _window_list(self.window),
+            "padded": _window_list(self.padded),
+        }
+
+    @staticmethod
+    def from_dict(d: dict[str, Any]) -> "Partition":
+        return Partition(id=d["id"], row=d["row"], col=d["col"],
+                         window=Window(*d["window"]), padded=Window(*d["padded"]))
+
+
+def _window_list(w: Window) -> list[int]:
+    return [int(w.col_off), int(w.row_off), int(w.width), int(w.height)]
+
+
+def plan_partitions(height: int, width: int, size: int, overlap: int = 0) -> list[Partition]:
+    """Grid of `size` x `size` cores (edge cells smaller) over a height x width raster."""
+    n_rows, n_cols = -(-height // size), -(-width // size)
+    digits = max(3, len(str(max(n_rows, n_cols))))
+    parts = []
+    for r in range(n_rows):
+        for c in range(n_cols):
+            row0, col0 = r * size, c * size
+            h, w = min(size, height - row0), min(size, width - col0)
+            prow0, pcol0 = max(0, row0 - overlap), max(0, col0 - overlap)
+            prow1 = min(height, row0 + h + overlap)
+            pcol1 = min(width, col0 + w + overlap)
+            parts.append(Partition(
+                id=f"r{r:0{digits}d}_c{c:0{digits}d}", row=r, col=c,
+                window=Window(col0, row0, w, h),
+                padded=Window(pcol0, prow0, pcol1 - pcol0, prow1 - prow0),
+            ))
+    return parts
+
+
+def write_jobs(parts: Iterable[Partition], path: Path, **common: Any) -> Path:
+    """One JSON object per line; `common` (e.g. the AOI and raster) is repeated on each."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        for p in parts:
+            f.write(json.dumps({**common, **p.to_dict()}) + "\n")
+    return path
+
+
+def read_jobs(path: Path, ids: Sequence[str] | None = None) -> list[Partition]:
+    with open(path) as f:
+        parts = [Partition.from_dict(json.loads(line)) for line in f if line.strip()]
+    if ids:
+        wanted = set(ids)
+        unknown = wanted - {p.id for p in parts}
+        if unknown:
+            raise KeyError(f"partitions not in {path}: {', '.join(sorted(unknown))}")
+        parts = [p for p in parts if p.id in wanted]
+    return parts
+
+
+def run_partitions(
+    fn: Callable[[Partition], Any],
+    parts: Sequence[Partition],
+    workers: int = 1,
+    initializer: Callable | None = None,
+    initargs: tuple = (),
+) -> Iterator[Any]:
+    """Apply `fn` to every partition, in processes when workers > 1; yields in input order.
+
+    Lazy, so a raster stage can write each result as it arrives instead of
+    holding the whole AOI. `fn` must be a module-level function so it pickles.
+    Large shared inputs go through `initializer`, which runs once per worker
+    rather than once per task.
+    """
+    if workers <= 1:
+        if initializer:
+            initializer(*initargs)
+        yield from (fn(p) for p in parts)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer,
+                             initargs=initargs) as pool:
+        yield from pool.map(fn, parts)
+
+
+def mosaic_cores(dst, results: Iterable[tuple[Partition, np.ndarray]], band: int | None = None) -> None:
+    """Write each partition's result (computed over `padded`) into `dst` at its core."""
+    for part, arr in results:
+        core = part.crop_core(arr)
+        if band is None:
+            dst.write(core if core.ndim == 3 else core[np.newaxis], window=part.window)
+        else:
+            dst.write(core, band, window=part.window)
+
+
+def sum_pair_counts(
+    partials: Iterable[tuple[np.ndarray, np.ndarray, np.ndarray]],
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Sum (a, b, count) contingency tables that may share (a, b) pairs."""
+    partials = [p for p in partials if len(p[2])]
+    if not partials:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    a = np.concatenate([p[0] for p in partials]).astype(np.int64)
+    b = np.concatenate([p[1] for p in partials]).astype(np.int64)
+    counts = np.concatenate([p[2] for p in partials]).astype(np.int64)
+    pairs, inverse = np.unique(np.stack([a, b]), axis=1, return_inverse=True)
+    return pairs[0], pairs[1], np.bincount(inverse.ravel(), weights=counts).astype(np.int64)
@@ -0,0 +1,241 @@
+"""A small content-addressed DAG runner for the pipeline scripts.
+
+A `Stage` is one script invocation with declared inputs, outputs, the slice of
+config it reads and the stages it must follow. Before a stage runs, its digest
+is computed from all of those plus the script's own source and its `shared`
+files (the `lib/` modules every script imports); if the digest matches the one
+recorded after its last successful run and every output is still on disk, the
+stage is skipped.
+
+A run only counts when every output exists afterwards and at least one was
+written: a script that exits 0 without touching them (e.g. one that skips
+existing outputs) is reported as failed and its digest is not recorded, so
+stale outputs are never blessed.
+
+File hashes are cached by (size, mtime) in the state file, so a multi-GB AEF
+raster is read once, not on every invocation. Directories hash as the sorted
+set of their files.
+
+Independent stages run concurrently, each as a subprocess whose output goes to
+its own log file (interleaved progress lines from parallel stages are useless).
+"""
+import hashlib
+import json
+import subprocess
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable
+
+
+@dataclass(frozen=True)
+class Stage:
+    name: str
+    command: tuple[str, ...]
+    script: Path
+    inputs: Callable[[], list[Path]]
+    outputs: tuple[Path, ...]
+    config: Any = None
+    deps: tuple[str, ...] = ()
+    shared: tuple[Path, ...] = ()
+
+
+@dataclass(frozen=True)
+class StageResult:
+    name: str
+    status: str  # ran | skipped | failed | blocked | stale (dry run)
+    seconds: float = 0.0
+    digest: str | None = None
+    detail: str = ""
+
+
+@dataclass
+class HashCache:
+    """sha256 per file, reused while (size, mtime_ns) is unchanged. Thread-safe."""
+
+    entries: dict[str, dict[str, Any]] = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def file(self, path: Path) -> str:
+        st = path.stat()
+        key = str(path.resolve())
+        with self.lock:
+            hit = self.entries.get(key)
+        if hit and hit["size"] == st.st_size and hit["mtime_ns"] == st.st_mtime_ns:
+            return hit["sha256"]
+        with open(path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        with self.lock:
+            self.entries[key] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                                 "sha256": digest}
+        return digest
+
+    def snapshot(self) -> dict[str, dict[str, Any]]:
+        with self.lock:
+            return dict(self.entries)
+
+    def path(self, path: Path) -> str:
+        if not path.is_dir():
+            return self.file(path)
+        h = hashlib.sha256()
+        for p in sorted(q for q in path.rglob("*") if q.is_file()):
+            h.update(f"{p.relative_to(path)}\0{self.file(p)}\n".encode())
+        return h.hexdigest()
+
+
+def stage_digest(stage: Stage, hashes: HashCache) -> str:
+    missing = [p for p in stage.inputs() if not p.exists()]
+    if missing:
+        raise FileNotFoundError(f"{stage.name}: missing input {missing[0]}")
+    h = hashlib.sha256()
+    # Not the command line: flags like --profile-out must not invalidate outputs.
+    h.update(json.dumps([stage.name, stage.config], sort_keys=True, default=str).encode())
+    h.update(hashes.file(stage.script).encode())
+    for p in sorted(stage.shared):
+        h.update(f"{p}\0{hashes.file(p)}\n".encode())
+    for p in sorted(stage.inputs()):
+        h.update(f"{p}\0{hashes.path(p)}\n".encode())
+    return h.hexdigest()
+
+
+def output_stamp(path: Path) -> tuple:
+    """(file, size, mtime_ns) for an output file or every file under an output dir."""
+    if not path.exists():
+        return ()
+    files = sorted(q for q in path.rglob("*") if q.is_file()) if path.is_dir() else [path]
+    return tuple((str(q), q.stat().st_size, q.stat().st_mtime_ns) for q in files)
+
+
+def load_state(path: Path) -> dict[str, Any]:
+    if not path.exists():
+        return {"hashes": {}, "stages": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(path: Path, state: dict[str, Any]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=2)
+    tmp.replace(path)
+
+
+def select(stages: list[Stage], targets: list[str] | None) -> list[Stage]:
+    """The targets and everything upstream of them, in declaration order."""
+    if not targets:
+        return stages
+    by_name = {s.name: s for s in stages}
+    unknown = set(targets) - set(by_name)
+    if unknown:
+        raise KeyError(f"unknown stages: {', '.join(sorted(unknown))}; "
+                       f"known: {', '.join(by_name)}")
+    keep, todo = set(), list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in keep:
+            keep.add(name)
+            todo.extend(by_name[name].deps)
+    return [s for s in stages if s.name in keep]
+
+
+def run_dag(
+    stages: list[Stage],
+    state_path: Path,
+    log_dir: Path,
+    jobs: int = 2,
+    force: bool = False,
+    dry_run: bool = False,
+) -> list[StageResult]:
+    state = load_state(state_path)
+    hashes = HashCache(state.get("hashes", {}))
+    by_name = {s.name: s for s in stages}
+    results: dict[str, StageResult] = {}
+    log_dir.mkdir(parents=True, exist_ok=True)
+
+    def execute(stage: Stage) -> StageResult:
+        try:
+            digest = stage_digest(stage, hashes)
+        except FileNotFoundError as e:
+            return StageResult(stage.name, "failed", detail=str(e))
+        recorded = state["stages"].get(stage.name, {}).get("digest")
+        fresh = recorded == digest and all(p.exists() for p in stage.outputs)
+        if fresh and not force:
+            return StageResult(stage.name, "skipped", digest=digest)
+        if dry_run:
+            return StageResult(stage.name, "stale", digest=digest)
+        log = log_dir / f"{stage.name}.log"
+        before = [output_stamp(p) for p in stage.outputs]
+        start = time.perf_counter()
+        with open(log, "w") as f:
+            proc = subprocess.run(stage.command, stdout=f, stderr=subprocess.STDOUT)
+        seconds = time.perf_counter() - start
+        if proc.returncode != 0:
+            return StageResult(stage.name, "failed", seconds,
+                               detail=f"exit {proc.returncode}, see {log}")
+        missing = [p for p in stage.outputs if not p.exists()]
+        if missing:
+            return StageResult(stage.name, "failed", seconds,
+                               detail=f"{missing[0]} not written, see {log}")
+        if stage.outputs and [output_stamp(p) for p in stage.outputs] == before:
+            return StageResult(stage.name, "failed", seconds,
+                               detail=f"outputs left unchanged, see {log}")
+        return StageResult(stage.name, "ran", seconds, digest)
+
+    pending = list(stages)
+    running: dict[Future, Stage] = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        while pending or running:
+            for stage in list(pending):
+                dep_status = [results[d].status if d in results else None
+                              for d in stage.deps if d in by_name]
+                if any(s in ("failed", "blocked") for s in dep_status):
+                    pending.remove(stage)
+                    results[stage.name] = StageResult(stage.name, "blocked")
+                elif dry_run and "stale" in dep_status:
+                    pending.remove(stage)
+                    results[stage.name] = StageResult(stage.name, "stale",
+                                                      detail="upstream is stale")
+                elif all(s in ("ran", "skipped") for s in dep_status):
+                    pending.remove(stage)
+                    print(f"▶ {stage.name}")
+                    running[pool.submit(execute, stage)] = stage
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                stage = running.pop(fut)
+                res = fut.result()
+                results[stage.name] = res
+                print(f"{_ICONS[res.status]} {stage.name}: {res.status}"
+                      f"{f' in {res.seconds:.1f}s' if res.seconds else ''}"
+                      f"{f' ({res.detail})' if res.detail else ''}")
+                if res.status == "ran":
+                    state["stages"][stage.name] = {
+                        "digest": res.digest, "seconds": round(res.seconds, 2),
+                        "finished": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    }
+                    state["hashes"] = hashes.snapshot()
+                    save_state(state_path, state)
+    state["hashes"] = hashes.snapshot()
+    if not dry_run:
+        save_state(state_path, state)
+    return [results[s.name] for s in stages]
+
+
+def critical_path(stages: list[Stage], results: list[StageResult]) -> tuple[list[str], float]:
+    """Longest chain of this run's stage durations through the DAG."""
+    seconds = {r.name: r.seconds for r in results}
+    by_name = {s.name: s for s in stages}
+    best: dict[str, tuple[float, list[str]]] = {}
+    for stage in stages:  # declaration order is topological
+        upstream = [best[d] for d in stage.deps if d in by_name]
+        total, chain = max(upstream, default=(0.0, []), key=lambda t: t[0])
+        best[stage.name] = (total + seconds.get(stage.name, 0.0), chain + [stage.name])
+    total, chain = max(best.values(), default=(0.0, []), key=lambda t: t[0])
+    return chain, total
+
+
+_ICONS = {"ran": "✅", "skipped": "⏭ ", "failed": "❌", "blocked": "⛔", "stale": "🔸"}
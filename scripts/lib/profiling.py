@@ -0,0 +1,276 @@
+"""Stage timers shared by the pipeline scripts.
+
+Each script wraps its expensive steps in `profiler.stage("name")`. A stage
+records wall time, CPU time, peak RSS, bytes read/written by the process and,
+when the caller reports how many pixels it touched, pixel throughput. Stages
+nest; the trace keeps the nesting so a slow run can be read top-down.
+
+Work done in worker processes counts too. `cpu_s` adds the CPU of children
+reaped during the stage (`child_cpu_s` on its own); `run_partitions` shuts
+its pool down before returning, so a stage that fans out is charged for its
+workers. `child_peak_rss_mb` is the largest worker reaped so far - a
+high-water mark, since the kernel keeps no per-stage figure for children.
+
+`peak_rss_mb` is the stage's own peak on Linux: the high-water mark is reset
+through `/proc/self/clear_refs` as each stage opens (`rss_scope: "stage"`).
+Elsewhere it is the process's lifetime peak (`rss_scope: "process"`).
+
+Nothing is written unless the script was given `--profile-out`:
+
+    --profile-out run.jsonl   one JSON object per stage, in completion order
+    --profile-out run.json    Chrome trace format (chrome://tracing, Perfetto)
+
+`--profile-cprofile DIR` additionally runs every stage marked `hot=True` under
+cProfile and dumps `DIR/<stage>.prof` (open with `snakeviz` or `pstats`). For
+py-spy, attach to the PID the profiler prints at start-up; stage names are set
+as the thread name while a stage runs, so `py-spy dump` shows which one is live.
+
+Stdlib only: `esri_tiles.py download` must still run with nothing but pyyaml.
+"""
+import argparse
+import cProfile
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import wraps
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+# ru_maxrss is KiB on Linux, bytes on macOS.
+_RSS_SCALE = 1 if sys.platform == "darwin" else 1024
+
+
+def peak_rss_bytes() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RSS_SCALE
+
+
+def children_usage() -> tuple[float, int]:
+    """(CPU seconds, peak RSS bytes) of all reaped child processes so far."""
+    ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return ru.ru_utime + ru.ru_stime, ru.ru_maxrss * _RSS_SCALE
+
+
+def rss_high_water() -> int | None:
+    """VmHWM in bytes, resettable through `reset_rss_high_water`; None off Linux."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_rss_high_water() -> bool:
+    """Drop VmHWM to the current RSS (Linux >= 4.0)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def io_counters() -> tuple[int, int] | None:
+    """(bytes read, bytes written) through read/write syscalls, or None off Linux.
+
+    `rchar`/`wchar` rather than `read_bytes`/`write_bytes`: a re-run reads the
+    same rasters out of page cache, and the question a trace answers is how much
+    data a stage pushed through, not how much the disk happened to serve.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except OSError:
+        return None
+
+
+@dataclass
+class StageRecord:
+    """Mutable on purpose: the stage body fills in `pixels` and `extra` as it runs."""
+
+    name: str
+    depth: int
+    start: float
+    wall_s: float = 0.0
+    cpu_s: float = 0.0
+    child_cpu_s: float = 0.0
+    peak_rss_mb: float = 0.0
+    rss_scope: str = "process"
+    child_peak_rss_mb: float | None = None
+    read_mb: float | None = None
+    written_mb: float | None = None
+    pixels: int = 0
+    extra: dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def mpix_per_s(self) -> float | None:
+        return self.pixels / self.wall_s / 1e6 if self.pixels and self.wall_s else None
+
+    def add_pixels(self, n: int) -> None:
+        self.pixels += int(n)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "stage": self.name,
+            "depth": self.depth,
+            "wall_s": round(self.wall_s, 4),
+            "cpu_s": round(self.cpu_s, 4),
+            "child_cpu_s": round(self.child_cpu_s, 4),
+            "peak_rss_mb": round(self.peak_rss_mb, 1),
+            "rss_scope": self.rss_scope,
+            "child_peak_rss_mb": None if self.child_peak_rss_mb is None
+            else round(self.child_peak_rss_mb, 1),
+            "read_mb": None if self.read_mb is None else round(self.read_mb, 2),
+            "written_mb": None if self.written_mb is None else round(self.written_mb, 2),
+            "pixels": self.pixels,
+            "mpix_per_s": None if self.mpix_per_s is None else round(self.mpix_per_s, 2),
+            **self.extra,
+        }
+
+
+class Profiler:
+    """Collects `StageRecord`s for one script run and writes them on `close()`."""
+
+    def __init__(self, script: str, out: Path | None = None,
+                 cprofile_dir: Path | None = None):
+        self.script = script
+        self.out = out
+        self.cprofile_dir = cprofile_dir
+        self.records: list[StageRecord] = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._depth = threading.local()
+        self._open: list[StageRecord] = []
+
+    @staticmethod
+    def from_args(script: str, args: argparse.Namespace) -> "Profiler":
+        out = getattr(args, "profile_out", None)
+        cprof = getattr(args, "profile_cprofile", None)
+        profiler = Profiler(script, Path(out) if out else None,
+                            Path(cprof) if cprof else None)
+        if profiler.enabled:
+            print(f"⏱  profiling {script} (pid {os.getpid()}) -> {profiler.out}")
+        return profiler
+
+    @property
+    def enabled(self) -> bool:
+        return self.out is not None
+
+    @contextmanager
+    def stage(self, name: str, pixels: int = 0, hot: bool = False) -> Iterator[StageRecord]:
+        depth = getattr(self._depth, "value", 0)
+        rec = StageRecord(name=name, depth=depth,
+                          start=time.perf_counter() - self._origin, pixels=pixels)
+        with self._lock:
+            # Resetting the high-water mark would hide what enclosing stages
+            # have peaked at so far, so credit it to them first. Unprofiled
+            # runs skip the /proc traffic: nothing would be written anyway.
+            if self.enabled:
+                self._fold_rss_high_water()
+                if reset_rss_high_water():
+                    rec.rss_scope = "stage"
+            self._open.append(rec)
+        io0 = io_counters() if self.enabled else None
+        cpu0 = time.process_time()
+        child_cpu0, child_rss0 = children_usage()
+        thread = threading.current_thread()
+        prev_thread_name = thread.name
+        prof = cProfile.Profile() if hot and self.cprofile_dir else None
+        self._depth.value = depth + 1
+        thread.name = name
+        if prof:
+            prof.enable()
+        try:
+            yield rec
+        finally:
+            if prof:
+                prof.disable()
+                self.cprofile_dir.mkdir(parents=True, exist_ok=True)
+                prof.dump_stats(self.cprofile_dir / f"{name.replace('/', '_')}.prof")
+            thread.name = prev_thread_name
+            self._depth.value = depth
+            rec.wall_s = time.perf_counter() - self._origin - rec.start
+            child_cpu1, child_rss1 = children_usage()
+            rec.child_cpu_s = child_cpu1 - child_cpu0
+            rec.cpu_s = time.process_time() - cpu0 + rec.child_cpu_s
+            if rec.child_cpu_s or child_rss1 != child_rss0:
+                rec.child_peak_rss_mb = child_rss1 / 1e6
+            io1 = io_counters() if self.enabled else None
+            if io0 and io1:
+                rec.read_mb = (io1[0] - io0[0]) / 1e6
+                rec.written_mb = (io1[1] - io0[1]) / 1e6
+            with self._lock:
+                if self.enabled:
+                    self._fold_rss_high_water()
+                self._open.remove(rec)
+                if self.enabled and rec.rss_scope == "process":
+                    rec.peak_rss_mb = peak_rss_bytes() / 1e6
+                self.records.append(rec)
+
+    def _fold_rss_high_water(self) -> None:
+        hwm = rss_high_water()
+        if hwm is None:
+            return
+        for rec in self._open:
+            if rec.rss_scope == "stage":
+                rec.peak_rss_mb = max(rec.peak_rss_mb, hwm / 1e6)
+
+    def timed(self, name: str | None = None, hot: bool = False) -> Callable:
+        """Decorator form of `stage`, named after the function by default."""
+        def wrap(fn: Callable) -> Callable:
+            @wraps(fn)
+            def inner(*args, **kwargs):
+                with self.stage(name or fn.__name__, hot=hot):
+                    return fn(*args, **kwargs)
+            return inner
+        return wrap
+
+    def close(self) -> None:
+        if not self.enabled:
+            return
+        self.out.parent.mkdir(parents=True, exist_ok=True)
+        if self.out.suffix == ".jsonl":
+            with open(self.out, "w") as f:
+                for rec in self.records:
+                    f.write(json.dumps({"script": self.script, **rec.to_dict()}) + "\n")
+        else:
+            with open(self.out, "w") as f:
+                json.dump(self.chrome_trace(), f)
+        print(f"⏱  {len(self.records)} stages -> {self.out}")
+        for rec in sorted(self.records, key=lambda r: r.start):
+            rate = f"  {rec.mpix_per_s:.1f} Mpx/s" if rec.mpix_per_s else ""
+            print(f"   {'  ' * rec.depth}{rec.name:<{32 - 2 * rec.depth}} "
+                  f"{rec.wall_s:8.2f}s wall {rec.cpu_s:8.2f}s cpu "
+                  f"{rec.peak_rss_mb:8.0f} MB peak{rate}"
+                  + (f"  ({rec.child_cpu_s:.2f}s cpu in workers)" if rec.child_cpu_s else ""))
+
+    def chrome_trace(self) -> dict[str, Any]:
+        pid = os.getpid()
+        events = [
+            {"name": rec.name, "cat": self.script, "ph": "X", "pid": pid, "tid": 0,
+             "ts": round(rec.start * 1e6), "dur": round(rec.wall_s * 1e6),
+             "args": rec.to_dict()}
+            for rec in sorted(self.records, key=lambda r: r.start)
+        ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def __enter__(self) -> "Profiler":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def add_profile_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--profile-out",
+                        help="write a stage trace: .jsonl for JSON lines, else Chrome trace JSON")
+    parser.add_argument("--profile-cprofile", metavar="DIR",
+                        help="dump cProfile stats for hot stages into DIR")
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""Polygonize each k-raster into simplified, spatially indexed vector layers.
+
+The viewer hit-tests and outlines clusters against the pixel rasters, which
+gets slow and blocky on large AOIs. This writes, per k-level, one polygon per
+4-connected cluster region - the regions `rasterio.features.shapes` would
+give for the whole raster - plus coverage-simplified copies at coarser
+tolerances for zoomed-out rendering.
+
+- Windows are polygonized in worker processes, in pixel coordinates and
+  densified to one vertex per pixel edge, so neighbouring polygons share
+  exactly the same vertices whichever window traced them.
+- Regions cut by a window seam are re-joined by unioning, per cluster, only
+  the polygons that touch a seam.
+- Simplification is `shapely.coverage_simplify` over the whole layer:
+  neighbouring regions keep one shared boundary, so no gaps or overlaps
+  appear between them. Tolerances are in pixels.
+- Layers are FlatGeobuf, whose packed R-tree lets a reader fetch just the
+  features under a bbox; `index.json` lists them per k.
+
+Usage:
+    python scripts/polygonize_clusters.py [--aoi auroville-24-10] \
+        [--tolerances 1,4,16] [--block-size 1024] [--workers 4]
+"""
+
+import argparse
+import json
+import sys
+import traceback
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import fiona
+import numpy as np
+import rasterio
+import shapely
+from rasterio.features import shapes
+from rasterio.transform import Affine
+from shapely.geometry import mapping, shape
+
+sys.path.insert(0, str(Path(__file__).parent))
+from lib.config import get_current_segmentation, load_config, resolve_aoi_path
+from lib.partition import Partition, plan_partitions, run_partitions
+from lib.profiling import Profiler, add_profile_args
+
+SCHEMA = {"geometry": "Polygon", "properties": {"cluster_id": "int", "pixels": "int"}}
+
+
+@dataclass(frozen=True)
+class PolygonizeConfig:
+    segmentation_dir: Path
+    manifest_path: Path
+    output_dir: Path
+    verbose: bool
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], verbose: bool) -> "PolygonizeConfig":
+        aoi_path = config["aoi_path"]
+        aoi_config = config["aoi_config"]
+        _, seg_config = get_current_segmentation(aoi_config)
+        files_config = aoi_config.get("files", {})
+        intermediates_rel = files_config.get("intermediates_dir", "intermediates")
+        output_subdir = seg_config.get("output_subdir", "clusters")
+        segmentation_dir = resolve_aoi_path(
+            aoi_path, f"{intermediates_rel}/{output_subdir}"
+        )
+        return cls(
+            segmentation_dir=segmentation_dir,
+            manifest_path=segmentation_dir / "manifest.json",
+            output_dir=resolve_aoi_path(aoi_path, f"{intermediates_rel}/cluster_polygons"),
+            verbose=verbose,
+        )
+
+    def validate(self) -> None:
+        if not self.manifest_path.exists():
+            raise FileNotFoundError(f"Manifest not found: {self.manifest_path}")
+
+
+_worker_seg: Path | None = None
+
+
+def _init_polygonize_worker(seg_path: Path) -> None:
+    global _worker_seg
+    _worker_seg = seg_path
+
+
+def polygonize_partition(part: Partition) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(cluster IDs, polygons in raster pixel coordinates, touches-a-seam) for one window."""
+    with rasterio.open(_worker_seg) as src:
+        ids = src.read(1, window=part.window)
+        nodata = -1 if src.nodata is None else int(src.nodata)
+        height, width = src.height, src.width
+    col0, row0 = int(part.window.col_off), int(part.window.row_off)
+    col1, row1 = col0 + ids.shape[1], row0 + ids.shape[0]
+    valid = (ids != nodata) & (ids >= 0)
+    cluster_ids, polygons = [], []
+    for geom, value in shapes(
+        ids, mask=valid, connectivity=4, transform=Affine.translation(col0, row0)
+    ):
+        cluster_ids.append(int(value))
+        polygons.append(shape(geom))
+    polygons = shapely.segmentize(np.asarray(polygons, dtype=object), 1.0)
+    bounds = shapely.bounds(polygons).reshape(-1, 4)
+    on_seam = (
+        ((bounds[:, 0] == col0) & (col0 > 0))
+        | ((bounds[:, 1] == row0) & (row0 > 0))
+        | ((bounds[:, 2] == col1) & (col1 < width))
+        | ((bounds[:, 3] == row1) & (row1 < height))
+    )
+    return np.asarray(cluster_ids, dtype=np.int64), polygons, on_seam
+
+
+def stitch_seams(
+    results: List[Tuple[np.ndarray, np.ndarray, np.ndarray]],
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Join window pieces of the same region; returns (cluster IDs, polygons)."""
+    ids = np.concatenate([r[0] for r in results])
+    polygons = np.concatenate([r[1] for r in results])
+    on_seam = np.concatenate([r[2] for r in results])
+    out_ids, out_polygons = [ids[~on_seam]], [polygons[~on_seam]]
+    for cluster_id in np.unique(ids[on_seam]):
+        joined = shapely.get_parts(
+            shapely.union_all(polygons[on_seam & (ids == cluster_id)])
+        )
+        out_ids.append(np.full(len(joined), cluster_id, dtype=np.int64))
+        out_polygons.append(joined)
+    return np.concatenate(out_ids), np.concatenate(out_polygons)
+
+
+def to_map_coords(polygons: np.ndarray, transform: Affine) -> np.ndarray:
+    a, b, c, d, e, f = transform[:6]
+    return shapely.transform(
+        polygons,
+        lambda xy: np.column_stack(
+            [a * xy[:, 0] + b * xy[:, 1] + c, d * xy[:, 0] + e * xy[:, 1] + f]
+        ),
+    )
+
+
+def write_layer(
+    path: Path, ids: np.ndarray, pixels: np.ndarray, polygons: np.ndarray, crs
+) -> int:
+    keep = ~shapely.is_empty(polygons)
+    tmp = path.with_suffix(".partial.fgb")
+    with fiona.open(
+        tmp, "w", driver="FlatGeobuf", schema=SCHEMA, crs=crs.to_wkt() if crs else None
+    ) as dst:
+        dst.writerecords(
+            {
+                "geometry": mapping(polygon),
+                "properties": {"cluster_id": int(cid), "pixels": int(px)},
+            }
+            for cid, px, polygon in zip(ids[keep], pixels[keep], polygons[keep])
+        )
+    tmp.replace(path)
+    return int(keep.sum())
+
+
+def polygonize_segmentation(
+    seg_key: str,
+    seg_path: Path,
+    tolerances: List[float],
+    block_size: int,
+    workers: int,
+    config: PolygonizeConfig,
+    profiler: Profiler,
+) -> List[Dict[str, Any]]:
+    with rasterio.open(seg_path) as src:
+        height, width = src.height, src.width
+        transform, crs = src.transform, src.crs
+    parts = plan_partitions(height, width, block_size)
+    with profiler.stage(f"polygonize:{seg_key}", pixels=height * width, hot=True):
+        results = list(
+            run_partitions(
+                polygonize_partition,
+                parts,
+                workers,
+                initializer=_init_polygonize_worker,
+                initargs=(seg_path,),
+            )
+        )
+    with profiler.stage(f"stitch:{seg_key}"):
+        ids, polygons = stitch_seams(results)
+        # Pixel coordinates: a region's area is its pixel count.
+        pixels = np.rint(shapely.area(polygons)).astype(np.int64)
+
+    layers = []
+    for tolerance in [0.0, *tolerances]:
+        with profiler.stage(f"simplify:{seg_key}:{tolerance:g}"):
+            if tolerance:
+                simplified = shapely.coverage_simplify(polygons, tolerance)
+            else:
+                # Drop the one-per-pixel vertices along straight edges.
+                simplified = shapely.simplify(polygons, 0)
+            simplified = to_map_coords(simplified, transform)
+        name = f"{seg_key}.fgb" if not tolerance else f"{seg_key}.s{tolerance:g}.fgb"
+        with profiler.stage(f"write:{seg_key}:{tolerance:g}"):
+            n = write_layer(config.output_dir / name, ids, pixels, simplified, crs)
+        layers.append(
+            {
+                "tolerance_px": tolerance,
+                "file": name,
+                "features": n,
+                "vertices": int(shapely.get_num_coordinates(simplified).sum()),
+            }
+        )
+        if config.verbose:
+            print(
+                f"  ✅ {seg_key} @ {tolerance:g} px: {n} regions, "
+                f"{layers[-1]['vertices']} vertices -> {name}"
+            )
+    return layers
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Polygonize cluster rasters into simplified vector layers per k"
+    )
+    parser.add_argument("--aoi", help="AOI key from config.yaml; default aoi.current")
+    parser.add_argument(
+        "--verbose", action="store_true", default=True, help="Print detailed progress"
+    )
+    parser.add_argument(
+        "--tolerances",
+        default="1,4,16",
+        help="Comma-separated simplification tolerances in pixels",
+    )
+    parser.add_argument(
+        "--block-size", type=int, default=1024, help="Window edge in pixels per pass"
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Processes over windows")
+    add_profile_args(parser)
+    args = parser.parse_args()
+    tolerances = sorted(float(t) for t in args.tolerances.split(",") if t.strip())
+    project_root = Path(__file__).parent.parent
+    profiler = Profiler.from_args("polygonize_clusters", args)
+    try:
+        config_dict = load_config(project_root, args.aoi)
+        config = PolygonizeConfig.from_config(config_dict, args.verbose)
+        config.validate()
+        with open(config.manifest_path) as f:
+            manifest = json.load(f)
+        config.output_dir.mkdir(parents=True, exist_ok=True)
+        seg_paths = [
+            (seg_key, config.segmentation_dir / filename)
+            for seg_key, filename in zip(manifest["segmentation_keys"], manifest["files"])
+        ]
+        if config.verbose:
+            print("🚀 Starting cluster polygonization")
+            print(f"   AOI: {config_dict['aoi_name']}")
+            print(f"   Segmentations: {len(seg_paths)}")
+            print(f"   Tolerances (px): {', '.join(f'{t:g}' for t in tolerances)}")
+        index = {}
+        for seg_key, seg_path in seg_paths:
+            index[seg_key] = polygonize_segmentation(
+                seg_key, seg_path, tolerances, args.block_size, args.workers,
+                config, profiler,
+            )
+        with rasterio.open(seg_paths[0][1]) as src:
+            crs, res = src.crs, src.res
+        with open(config.output_dir / "index.json", "w") as f:
+            json.dump(
+                {
+                    "generated": datetime.now().isoformat(),
+                    "crs": str(crs),
+                    "pixel_size": list(res),
+                    "layers": index,
+                },
+                f,
+                indent=2,
+            )
+        if config.verbose:
+            print("\n✅ Cluster polygons written!")
+            print(f"💾 Saved to {config.output_dir}")
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        if args.verbose:
+            traceback.print_exc()
+        sys.exit(1)
+    finally:
+        profiler.close()
+
+
+if __name__ == "__main__":
+    main()
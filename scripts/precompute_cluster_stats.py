@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+
+import sys
+from pathlib import Path
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Tuple, Any
+import json
+import argparse
+import numpy as np
+import rasterio
+import traceback
+
+
+sys.path.insert(0, str(Path(__file__).parent))
+from lib.config import (
+    load_config,
+    get_source_config,
+    get_current_segmentation,
+    resolve_aoi_path,
+)
+from lib.partition import Partition, plan_partitions, run_partitions
+from lib.profiling import Profiler, add_profile_args
+
+# Metres per degree on the WGS84 ellipsoid near the equator. Good to ~1% at
+# Indian latitudes once x is scaled by cos(lat), which is what the legend needs.
+M_PER_DEG_LAT = 110_574.0
+M_PER_DEG_LON = 111_320.0
+
+
+@dataclass(frozen=True)
+class ClusterStatsConfig:
+    segmentation_dir: Path
+    manifest_path: Path
+    aef_file: Path
+    output_dir: Path
+    verbose: bool
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], verbose: bool) -> "ClusterStatsConfig":
+        aoi_path = config["aoi_path"]
+        aoi_config = config["aoi_config"]
+        _, seg_config = get_current_segmentation(aoi_config)
+        source_config = get_source_config(aoi_config, seg_config["source"])
+        files_config = aoi_config.get("files", {})
+        intermediates_rel = files_config.get("intermediates_dir", "intermediates")
+        output_subdir = seg_config.get("output_subdir", "clusters")
+        segmentation_dir = resolve_aoi_path(
+            aoi_path, f"{intermediates_rel}/{output_subdir}"
+        )
+        return cls(
+            segmentation_dir=segmentation_dir,
+            manifest_path=segmentation_dir / "manifest.json",
+            aef_file=resolve_aoi_path(aoi_path, source_config["input_file"]),
+            output_dir=resolve_aoi_path(aoi_path, f"{intermediates_rel}/cluster_stats"),
+            verbose=verbose,
+        )
+
+    def validate(self, embeddings: bool) -> None:
+        if not self.manifest_path.exists():
+            raise FileNotFoundError(f"Manifest not found: {self.manifest_path}")
+        if embeddings and not self.aef_file.exists():
+            raise FileNotFoundError(f"AEF file not found: {self.aef_file}")
+
+
+@dataclass(frozen=True)
+class ClusterStats:
+    """Per-cluster accumulators, indexed by cluster ID. Combine with `+`."""
+
+    count: np.ndarray
+    area: np.ndarray
+    sum_col: np.ndarray
+    sum_row: np.ndarray
+    min_col: np.ndarray
+    min_row: np.ndarray
+    max_col: np.ndarray
+    max_row: np.ndarray
+    emb_sum: np.ndarray | None = None
+    emb_count: np.ndarray | None = None
+
+    @staticmethod
+    def from_block(
+        ids: np.ndarray,
+        row_off: int,
+        col_off: int,
+        row_area: np.ndarray,
+        nodata: int,
+        embeddings: np.ndarray | None = None,
+    ) -> "ClusterStats":
+        """Accumulate one window: `ids` is (h, w), `row_area` the pixel area per row,
+        `embeddings` the matching (bands, h, w) AEF block."""
+        h, w = ids.shape
+        rows, cols = np.indices((h, w))
+        valid = (ids != nodata) & (ids >= 0)
+        flat = ids[valid].astype(np.int64)
+        n = int(flat.max()) + 1 if flat.size else 0
+        r, c = rows[valid] + row_off, cols[valid] + col_off
+        min_col = np.full(n, np.iinfo(np.int64).max)
+        min_row = np.full(n, np.iinfo(np.int64).max)
+        max_col = np.full(n, -1, dtype=np.int64)
+        max_row = np.full(n, -1, dtype=np.int64)
+        np.minimum.at(min_col, flat, c)
+        np.minimum.at(min_row, flat, r)
+        np.maximum.at(max_col, flat, c)
+        np.maximum.at(max_row, flat, r)
+        emb_sum = emb_count = None
+        if embeddings is not None:
+            emb_valid = valid & ~np.isnan(embeddings).any(axis=0)
+            emb_ids = ids[emb_valid].astype(np.int64)
+            emb_sum = np.stack(
+                [
+                    np.bincount(emb_ids, weights=band[emb_valid], minlength=n)[:n]
+                    for band in embeddings
+                ],
+                axis=1,
+            )
+            emb_count = np.bincount(emb_ids, minlength=n)[:n]
+        return ClusterStats(
+            count=np.bincount(flat, minlength=n),
+            area=np.bincount(flat, weights=row_area[r - row_off], minlength=n),
+            sum_col=np.bincount(flat, weights=c, minlength=n),
+            sum_row=np.bincount(flat, weights=r, minlength=n),
+            min_col=min_col,
+            min_row=min_row,
+            max_col=max_col,
+            max_row=max_row,
+            emb_sum=emb_sum,
+            emb_count=emb_count,
+        )
+
+    def __add__(self, other: "ClusterStats") -> "ClusterStats":
+        n = max(len(self.count), len(other.count))
+
+        def pad(a, b, fill, combine):
+            if a is None:
+                return None
+            shape = (n, *a.shape[1:])
+            pa, pb = np.full(shape, fill, dtype=a.dtype), np.full(shape, fill, dtype=b.dtype)
+            pa[: len(a)], pb[: len(b)] = a, b
+            return combine(pa, pb)
+
+        big = np.iinfo(np.int64).max
+        return ClusterStats(
+            count=pad(self.count, other.count, 0, np.add),
+            area=pad(self.area, other.area, 0, np.add),
+            sum_col=pad(self.sum_col, other.sum_col, 0, np.add),
+            sum_row=pad(self.sum_row, other.sum_row, 0, np.add),
+            min_col=pad(self.min_col, other.min_col, big, np.minimum),
+            min_row=pad(self.min_row, other.min_row, big, np.minimum),
+            max_col=pad(self.max_col, other.max_col, -1, np.maximum),
+            max_row=pad(self.max_row, other.max_row, -1, np.maximum),
+            emb_sum=pad(self.emb_sum, other.emb_sum, 0, np.add),
+            emb_count=pad(self.emb_count, other.emb_count, 0, np.add),
+        )
+
+    def to_columns(self, transform) -> Dict[str, list]:
+        """Columnar output for clusters with at least one pixel, in the raster's CRS."""
+        present = np.flatnonzero(self.count)
+        count = self.count[present]
+        # Pixel centres for the centroid, pixel edges for the bbox.
+        cx, cy = transform * (
+            self.sum_col[present] / count + 0.5,
+            self.sum_row[present] / count + 0.5,
+        )
+        west, north = transform * (self.min_col[present], self.min_row[present])
+        east, south = transform * (self.max_col[present] + 1, self.max_row[present] + 1)
+        return {
+            "cluster_id": present.tolist(),
+            "pixel_count": count.tolist(),
+            "area_m2": np.round(self.area[present], 2).tolist(),
+            "bbox_west": np.minimum(west, east).tolist(),
+            "bbox_south": np.minimum(south, north).tolist(),
+            "bbox_east": np.maximum(west, east).tolist(),
+            "bbox_north": np.maximum(south, north).tolist(),
+            "centroid_x": cx.tolist(),
+            "centroid_y": cy.tolist(),
+        }
+
+    def mean_embeddings(self) -> np.ndarray:
+        present = np.flatnonzero(self.count)
+        counts = np.maximum(self.emb_count[present], 1)[:, None]
+        means = self.emb_sum[present] / counts
+        means[self.emb_count[present] == 0] = np.nan
+        return means.astype(np.float32)
+
+
+def row_pixel_area(src, row_off: int, height: int) -> np.ndarray:
+    """Pixel area in m² for each row of a window; varies with latitude in degrees."""
+    t = src.transform
+    if not (src.crs and src.crs.is_geographic):
+        return np.full(height, abs(t.a * t.e))
+    lat = t.f + t.e * (np.arange(row_off, row_off + height) + 0.5)
+    return (
+        abs(t.a) * M_PER_DEG_LON * np.cos(np.radians(lat)) * abs(t.e) * M_PER_DEG_LAT
+    )
+
+
+def check_same_grid(reference: Path, paths: List[Path]) -> None:
+    """Windows are read by pixel offset, so every raster must share one grid."""
+    with rasterio.open(reference) as ref:
+        grid = (ref.width, ref.height, ref.transform, ref.crs)
+    for path in paths:
+        with rasterio.open(path) as src:
+            other = (src.width, src.height, src.transform, src.crs)
+        if other != grid:
+            raise ValueError(
+                f"{path.name} is {other[0]}x{other[1]} at {other[2][:6]} in {other[3]}, "
+                f"but {reference.name} is {grid[0]}x{grid[1]} at {grid[2][:6]} in "
+                f"{grid[3]}; they must share a grid"
+            )
+
+
+_worker_segs: List[Tuple[str, Path]] = []
+_worker_aef: Path | None = None
+
+
+def _init_stats_worker(seg_paths: List[Tuple[str, Path]], aef_file: Path | None) -> None:
+    global _worker_segs, _worker_aef
+    _worker_segs = seg_paths
+    _worker_aef = aef_file
+
+
+def stats_for_partition(part: Partition) -> Dict[str, ClusterStats]:
+    """One window of every k-raster (and of the AEF raster, read once) to stats."""
+    embeddings = None
+    if _worker_aef is not None:
+        with rasterio.open(_worker_aef) as src:
+            embeddings = src.read(window=part.window).astype(np.float32)
+    stats = {}
+    for seg_key, seg_path in _worker_segs:
+        with rasterio.open(seg_path) as src:
+            ids = src.read(1, window=part.window)
+            row_area = row_pixel_area(
+                src, int(part.window.row_off), int(part.window.height)
+            )
+            nodata = -1 if src.nodata is None else int(src.nodata)
+        stats[seg_key] = ClusterStats.from_block(
+            ids,
+            int(part.window.row_off),
+            int(part.window.col_off),
+            row_area,
+            nodata,
+            embeddings,
+        )
+    return stats
+
+
+def write_stats(
+    seg_key: str, stats: ClusterStats, transform, crs, config: ClusterStatsConfig
+) -> None:
+    embedding_file = None
+    if stats.emb_sum is not None:
+        embedding_file = f"{seg_key}.embeddings.npy"
+        np.save(config.output_dir / embedding_file, stats.mean_embeddings())
+    columns = stats.to_columns(transform)
+    output = {
+        "segmentation_key": seg_key,
+        "generated": datetime.now().isoformat(),
+        "crs": str(crs),
+        "n_clusters": len(columns["cluster_id"]),
+        "columns": columns,
+        "embedding_file": embedding_file,
+    }
+    output_path = config.output_dir / f"{seg_key}.json"
+    with open(output_path, "w") as f:
+        json.dump(output, f, separators=(",", ":"))
+    if config.verbose:
+        print(f"  ✅ {seg_key}: {output['n_clusters']} clusters -> {output_path.name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precompute per-cluster area, bbox, centroid and mean embedding"
+    )
+    parser.add_argument("--aoi", help="AOI key from config.yaml; default aoi.current")
+    parser.add_argument(
+        "--verbose", action="store_true", default=True, help="Print detailed progress"
+    )
+    parser.add_argument(
+        "--embeddings",
+        action="store_true",
+        help="Also average the AEF embedding vector per cluster",
+    )
+    parser.add_argument(
+        "--block-size", type=int, default=1024, help="Window edge in pixels per pass"
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Processes over windows")
+    add_profile_args(parser)
+    args = parser.parse_args()
+    project_root = Path(__file__).parent.parent
+    profiler = Profiler.from_args("precompute_cluster_stats", args)
+    try:
+        config_dict = load_config(project_root, args.aoi)
+        config = ClusterStatsConfig.from_config(config_dict, args.verbose)
+        config.validate(args.embeddings)
+        with open(config.manifest_path) as f:
+            manifest = json.load(f)
+        config.output_dir.mkdir(parents=True, exist_ok=True)
+        seg_paths = [
+            (seg_key, config.segmentation_dir / filename)
+            for seg_key, filename in zip(
+                manifest["segmentation_keys"], manifest["files"]
+            )
+        ]
+        check_same_grid(
+            seg_paths[0][1],
+            [p for _, p in seg_paths[1:]] + ([config.aef_file] if args.embeddings else []),
+        )
+        with rasterio.open(seg_paths[0][1]) as src:
+            height, width = src.height, src.width
+            transform, crs = src.transform, src.crs
+        parts = plan_partitions(height, width, args.block_size)
+        if config.verbose:
+            print("🚀 Starting cluster statistics")
+            print(f"   AOI: {config_dict['aoi_name']}")
+            print(f"   Segmentations: {len(seg_paths)}")
+            print(f"   Windows: {len(parts)} on {args.workers} workers")
+            if args.embeddings:
+                print(f"   Embeddings: {config.aef_file}")
+        totals: Dict[str, ClusterStats] = {}
+        with profiler.stage(
+            "accumulate", pixels=height * width * len(seg_paths), hot=True
+        ):
+            for part_stats in run_partitions(
+                stats_for_partition,
+                parts,
+                args.workers,
+                initializer=_init_stats_worker,
+                initargs=(seg_paths, config.aef_file if args.embeddings else None),
+            ):
+                for seg_key, stats in part_stats.items():
+                    totals[seg_key] = (
+                        totals[seg_key] + stats if seg_key in totals else stats
+                    )
+        with profiler.stage("write"):
+            for seg_key, _ in seg_paths:
+                write_stats(seg_key, totals[seg_key], transform, crs, config)
+        if config.verbose:
+            print("\n✅ Cluster statistics computed!")
+            print(f"💾 Saved to {config.output_dir}")
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        if args.verbose:
+            traceback.print_exc()
+        sys.exit(1)
+    finally:
+        profiler.close()
+
+
+if __name__ == "__main__":
+    main()
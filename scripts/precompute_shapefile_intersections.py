@@ -10,7 +10,7 @@ import argparse
 import numpy as np
 import rasterio
 from rasterio.features import rasterize
-import fiona
+from rasterio.windows import bounds as window_bounds
 import traceback
 
 
@@ -20,6 +20,23 @@ from lib.config import (
     get_current_segmentation,
     resolve_aoi_path,
 )
+from lib.features import FeatureSet, load_features
+from lib.partition import (
+    Partition,
+    plan_partitions,
+    read_jobs,
+    run_partitions,
+    sum_pair_counts,
+    write_jobs,
+)
+from lib.profiling import Profiler, add_profile_args
+
+PairCounts = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+# Peak working set of one rasterize + count pass, per pixel, beyond the feature
+# raster itself: the int16 cluster raster, the valid mask, and the int64 pair
+# keys with np.unique's sort copy.
+COUNT_BYTES_PER_PIXEL = 2 + 1 + 8 + 8
 
 
 @dataclass(frozen=True)
@@ -30,9 +47,17 @@ class IntersectionConfig:
     output_dir: Path
     threshold_pct: float
     verbose: bool
+    feature_cache_path: Path | None = None
+    simplify: bool = False
 
     @classmethod
-    def from_config(cls, config: Dict[str, Any], verbose: bool) -> "IntersectionConfig":
+    def from_config(
+        cls,
+        config: Dict[str, Any],
+        verbose: bool,
+        use_cache: bool = True,
+        simplify: bool = False,
+    ) -> "IntersectionConfig":
         aoi_path = config["aoi_path"]
         aoi_config = config["aoi_config"]
         threshold = aoi_config["shapefile_intersection"]["min_intersection_pct"]
@@ -51,6 +76,11 @@ class IntersectionConfig:
         output_dir = resolve_aoi_path(
             aoi_path, f"{intermediates_rel}/shapefile_intersections"
         )
+        cache_name = (
+            config["global_config"]
+            .get("shapefile_intersection", {})
+            .get("cache_filename", "reference_labels")
+        )
         return cls(
             shapefile_path=shapefile_path,
             segmentation_dir=segmentation_dir,
@@ -58,6 +88,11 @@ class IntersectionConfig:
             output_dir=output_dir,
             threshold_pct=threshold,
             verbose=verbose,
+            # Not .json: the viewer loads every .json in output_dir as a k-level.
+            feature_cache_path=(
+                output_dir / f"{cache_name}.features.npz" if use_cache else None
+            ),
+            simplify=simplify,
         )
 
     def validate(self) -> None:
@@ -69,39 +104,33 @@ class IntersectionConfig:
             raise ValueError("Threshold must be between 0 and 100")
 
 
-def load_shapefile(
-    shapefile_path: Path, verbose: bool = False
-) -> Tuple[List[dict], List[dict]]:
-    geometries = []
-    properties = []
-    shapefile_uri = str(shapefile_path)
-    if shapefile_path.suffix == ".zip":
-        shapefile_uri = f"zip://{shapefile_path}"
-    with fiona.open(shapefile_uri) as src:
-        if verbose:
-            print(f"📂 Loading shapefile: {src.name}")
-            print(f"   CRS: {src.crs}")
-            print(f"   Features: {len(src)}")
-        for feature in src:
-            geometries.append(feature["geometry"])
-            properties.append(dict(feature.get("properties", {})))
-    return geometries, properties
+def load_shapefile(config: IntersectionConfig, reference_raster: Path) -> FeatureSet:
+    """Features whose bbox meets the reference raster, simplified to half a pixel
+    when `config.simplify` is set."""
+    with rasterio.open(reference_raster) as src:
+        bounds, crs, res = tuple(src.bounds), src.crs, src.res
+    return load_features(
+        config.shapefile_path,
+        bounds,
+        crs,
+        tolerance=min(res) / 2 if config.simplify else 0.0,
+        cache_path=config.feature_cache_path,
+        verbose=config.verbose,
+    )
 
 
 def rasterize_features(
-    geometries: List[dict], reference_raster_path: Path, verbose: bool = False
+    features: FeatureSet, reference_raster_path: Path, verbose: bool = False
 ) -> np.ndarray:
     with rasterio.open(reference_raster_path) as src:
         transform = src.transform
         shape = (src.height, src.width)
-        _crs = src.crs
-    shapes = [(geom, feature_id) for feature_id, geom in enumerate(geometries, start=1)]
     feature_raster = rasterize(
-        shapes,
+        features.shapes(),
         out_shape=shape,
         transform=transform,
         fill=0,  # 0 = no feature
-        dtype=np.uint16,
+        dtype=features.raster_dtype,
     )
     if verbose:
         unique_features = np.unique(feature_raster)
@@ -110,11 +139,52 @@ def rasterize_features(
     return feature_raster
 
 
+def count_pairs(
+    cluster_raster: np.ndarray, feature_raster: np.ndarray, nodata_value: int = -1
+) -> PairCounts:
+    """Contingency table of (cluster_id, feature_id) pixel counts, as three arrays.
+
+    Sparse: each pixel's pair is packed into one int64 key (cluster in the high
+    32 bits, feature in the low) and counted by sort. Only pairs that occur are
+    materialised, however large the uint32 feature-ID space is.
+    """
+    valid_mask = cluster_raster != nodata_value
+    keys = cluster_raster[valid_mask].astype(np.int64) << 32
+    keys |= feature_raster[valid_mask]
+    unique_keys, counts = np.unique(keys, return_counts=True)
+    return unique_keys >> 32, unique_keys & 0xFFFFFFFF, counts
+
+
+def auto_partition_size(
+    reference_raster: Path, features: FeatureSet, memory_mb: int
+) -> int:
+    """Partition edge that keeps one counting pass within `memory_mb`; 0 if the
+    whole raster already fits."""
+    with rasterio.open(reference_raster) as src:
+        pixels = src.height * src.width
+    per_pixel = np.dtype(features.raster_dtype).itemsize + COUNT_BYTES_PER_PIXEL
+    budget = memory_mb * 1024**2
+    if pixels * per_pixel <= budget:
+        return 0
+    return max(256, int((budget / per_pixel) ** 0.5) // 256 * 256)
+
+
 def compute_intersections(
     cluster_raster: np.ndarray,
     feature_raster: np.ndarray,
     threshold_pct: float,
     nodata_value: int = -1,
+) -> Tuple[Dict, Dict]:
+    return intersections_from_counts(
+        *count_pairs(cluster_raster, feature_raster, nodata_value), threshold_pct
+    )
+
+
+def intersections_from_counts(
+    cluster_ids: np.ndarray,
+    feature_ids: np.ndarray,
+    counts: np.ndarray,
+    threshold_pct: float,
 ) -> Tuple[Dict, Dict]:
     """
     Compute bidirectional intersection indices.
@@ -126,13 +196,6 @@ def compute_intersections(
         feature_to_clusters: {feature_id: [(cluster_id, pct_of_cluster, count), ...]}
         cluster_to_features: {cluster_id: [(feature_id, pct_of_cluster, count), ...]}
     """
-    valid_mask = cluster_raster != nodata_value
-    valid_clusters = cluster_raster[valid_mask]
-    valid_features = feature_raster[valid_mask]
-    pairs = np.stack([valid_clusters, valid_features], axis=0)
-    unique_pairs, counts = np.unique(pairs, axis=1, return_counts=True)
-    cluster_ids = unique_pairs[0]
-    feature_ids = unique_pairs[1]
     cluster_totals = {}
     for cluster_id, count in zip(cluster_ids, counts):
         cluster_totals[cluster_id] = cluster_totals.get(cluster_id, 0) + count
@@ -164,19 +227,39 @@ def process_segmentation(
     seg_key: str,
     seg_path: Path,
     feature_raster: np.ndarray,
-    feature_properties: List[dict],
+    feature_properties: Dict[str, dict],
     config: IntersectionConfig,
+    profiler: Profiler,
 ) -> None:
     if config.verbose:
         print(f"\n📊 Processing {seg_key}...")
-    with rasterio.open(seg_path) as src:
-        cluster_raster = src.read(1)
-    feature_to_clusters, cluster_to_features = compute_intersections(
-        cluster_raster, feature_raster, config.threshold_pct
+    with profiler.stage(f"{seg_key}/read_raster"):
+        with rasterio.open(seg_path) as src:
+            cluster_raster = src.read(1)
+    with profiler.stage(
+        f"{seg_key}/contingency", pixels=cluster_raster.size, hot=True
+    ):
+        feature_to_clusters, cluster_to_features = compute_intersections(
+            cluster_raster, feature_raster, config.threshold_pct
+        )
+    write_segmentation(
+        seg_key,
+        feature_to_clusters,
+        cluster_to_features,
+        feature_properties,
+        config,
+        profiler,
     )
-    feature_props_dict = {
-        str(i): props for i, props in enumerate(feature_properties, start=1)
-    }
+
+
+def write_segmentation(
+    seg_key: str,
+    feature_to_clusters: Dict,
+    cluster_to_features: Dict,
+    feature_properties: Dict[str, dict],
+    config: IntersectionConfig,
+    profiler: Profiler,
+) -> None:
     output = {
         "segmentation_key": seg_key,
         "shapefile": config.shapefile_path.name,
@@ -188,17 +271,145 @@ def process_segmentation(
         "cluster_to_features": {
             str(cid): features for cid, features in cluster_to_features.items()
         },
-        "feature_properties": feature_props_dict,
+        "feature_properties": feature_properties,
     }
     output_path = config.output_dir / f"{seg_key}.json"
-    with open(output_path, "w") as f:
-        json.dump(output, f, indent=2)
+    with profiler.stage(f"{seg_key}/json_dump"):
+        with open(output_path, "w") as f:
+            json.dump(output, f, indent=2)
     if config.verbose:
         print(f"  ✅ {len(feature_to_clusters)} features with intersections")
         print(f"  ✅ {len(cluster_to_features)} clusters with intersections")
         print(f"  💾 Saved to {output_path}")
 
 
+_partition_features: FeatureSet | None = None
+_partition_segs: List[Tuple[str, Path]] = []
+_partition_reference: Path | None = None
+
+
+def _init_partition_worker(
+    features: FeatureSet, seg_paths: List[Tuple[str, Path]], reference_raster: Path
+) -> None:
+    global _partition_features, _partition_segs, _partition_reference
+    _partition_features = features
+    _partition_segs = seg_paths
+    _partition_reference = reference_raster
+
+
+def count_partition(part: Partition) -> Dict[str, PairCounts]:
+    """Rasterize features over one partition's core and count pairs for every k.
+
+    Only features the STRtree finds within the core's bounds are burned.
+    """
+    with rasterio.open(_partition_reference) as src:
+        transform = src.window_transform(part.window)
+        local = _partition_features.within(window_bounds(part.window, src.transform))
+    feature_raster = rasterize(
+        local.shapes(),
+        out_shape=(int(part.window.height), int(part.window.width)),
+        transform=transform,
+        fill=0,
+        dtype=_partition_features.raster_dtype,
+    )
+    counts = {}
+    for seg_key, seg_path in _partition_segs:
+        with rasterio.open(seg_path) as src:
+            cluster_raster = src.read(1, window=part.window)
+        counts[seg_key] = count_pairs(cluster_raster, feature_raster)
+    return counts
+
+
+def save_partial(path: Path, counts: Dict[str, PairCounts]) -> None:
+    arrays = {
+        f"{seg_key}.{name}": arr
+        for seg_key, seg_counts in counts.items()
+        for name, arr in zip(("cluster", "feature", "count"), seg_counts)
+    }
+    np.savez(path, **arrays)
+
+
+def load_partial(path: Path) -> Dict[str, PairCounts]:
+    with np.load(path) as z:
+        keys = {name.rsplit(".", 1)[0] for name in z.files}
+        return {
+            k: (z[f"{k}.cluster"], z[f"{k}.feature"], z[f"{k}.count"]) for k in keys
+        }
+
+
+def run_partitioned(
+    args: argparse.Namespace,
+    partition_size: int,
+    config: IntersectionConfig,
+    features: FeatureSet,
+    reference_raster: Path,
+    seg_paths: List[Tuple[str, Path]],
+    profiler: Profiler,
+) -> bool:
+    """Partitioned counting. Returns True once the per-k outputs have been written.
+
+    Four modes, so one AOI can be spread across processes or machines:
+      --partition-size N               plan, count every partition here, merge
+      --partition-size N --jobs FILE   only write the job list
+      --jobs FILE --job ID ...         count those partitions, save partials
+      --jobs FILE --merge-partials     sum every partial listed in FILE
+    """
+    partials_dir = config.output_dir / "partials"
+    if partition_size:
+        with rasterio.open(reference_raster) as src:
+            parts = plan_partitions(src.height, src.width, partition_size)
+        if args.jobs:
+            write_jobs(parts, Path(args.jobs), raster=str(reference_raster))
+            print(f"📝 {len(parts)} partitions -> {args.jobs}")
+            return False
+    else:
+        parts = read_jobs(Path(args.jobs), args.job)
+    if args.merge_partials:
+        missing = [p.id for p in parts if not (partials_dir / f"{p.id}.npz").exists()]
+        if missing:
+            raise FileNotFoundError(
+                f"{len(missing)} partials missing, e.g. {', '.join(missing[:5])}"
+            )
+        with profiler.stage("load_partials"):
+            partials = [load_partial(partials_dir / f"{p.id}.npz") for p in parts]
+    else:
+        if config.verbose:
+            print(f"🧩 Counting {len(parts)} partitions on {args.workers} workers")
+        with profiler.stage("count_partitions", hot=True) as st:
+            partials = list(
+                run_partitions(
+                    count_partition,
+                    parts,
+                    args.workers,
+                    initializer=_init_partition_worker,
+                    initargs=(features, seg_paths, reference_raster),
+                )
+            )
+            st.add_pixels(sum(p.pixels for p in parts) * len(seg_paths))
+        if args.job:
+            partials_dir.mkdir(parents=True, exist_ok=True)
+            for part, counts in zip(parts, partials):
+                save_partial(partials_dir / f"{part.id}.npz", counts)
+            print(f"💾 {len(parts)} partials -> {partials_dir}")
+            return False
+    for seg_key, _ in seg_paths:
+        with profiler.stage(seg_key):
+            with profiler.stage(f"{seg_key}/merge_counts"):
+                counts = sum_pair_counts(partial[seg_key] for partial in partials)
+            feature_to_clusters, cluster_to_features = intersections_from_counts(
+                *counts, config.threshold_pct
+            )
+            write_segmentation(
+                seg_key,
+                feature_to_clusters,
+                cluster_to_features,
+                features.property_map(),
+                config,
+                profiler,
+            )
+    return True
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Precompute shapefile-cluster intersections"
@@ -206,11 +417,59 @@ def main():
     parser.add_argument(
         "--verbose", action="store_true", default=True, help="Print detailed progress"
     )
+    parser.add_argument("--aoi", help="AOI key from config.yaml; default aoi.current")
+    parser.add_argument(
+        "--partition-size",
+        type=int,
+        default=0,
+        help="Process the AOI in N x N pixel partitions instead of one raster",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Processes for partitioned counting"
+    )
+    parser.add_argument(
+        "--memory-mb",
+        type=int,
+        default=4096,
+        help="Partition automatically when one counting pass would exceed this",
+    )
+    parser.add_argument(
+        "--jobs", help="Partition job list (JSON lines) to write or to run from"
+    )
+    parser.add_argument(
+        "--job",
+        action="append",
+        help="Partition ID from --jobs to count; repeatable. Saves partial counts",
+    )
+    parser.add_argument(
+        "--merge-partials",
+        action="store_true",
+        help="Sum the saved partial counts for every job in --jobs",
+    )
+    parser.add_argument(
+        "--simplify",
+        action="store_true",
+        help="Simplify features to half a pixel before rasterizing",
+    )
+    parser.add_argument(
+        "--no-feature-cache",
+        action="store_true",
+        help="Re-read the shapefile instead of the clipped-feature cache",
+    )
+    add_profile_args(parser)
     args = parser.parse_args()
+    if (args.job or args.merge_partials) and not args.jobs:
+        parser.error("--job and --merge-partials need --jobs")
     project_root = Path(__file__).parent.parent
+    profiler = Profiler.from_args("precompute_shapefile_intersections", args)
     try:
-        config_dict = load_config(project_root)
-        config = IntersectionConfig.from_config(config_dict, args.verbose)
+        config_dict = load_config(project_root, args.aoi)
+        config = IntersectionConfig.from_config(
+            config_dict,
+            args.verbose,
+            use_cache=not args.no_feature_cache,
+            simplify=args.simplify,
+        )
         config.validate()
         with open(config.manifest_path) as f:
             manifest = json.load(f)
@@ -221,18 +480,54 @@ def main():
             print(f"   Threshold: {config.threshold_pct}%")
             print(f"   Shapefile: {config.shapefile_path}")
             print(f"   Segmentations: {len(manifest['files'])}")
-        geometries, feature_properties = load_shapefile(
-            config.shapefile_path, config.verbose
-        )
         reference_raster = config.segmentation_dir / manifest["files"][0]
-        feature_raster = rasterize_features(
-            geometries, reference_raster, config.verbose
+        with profiler.stage("load_shapefile") as st:
+            features = load_shapefile(config, reference_raster)
+            st.extra["features"] = len(features)
+        seg_paths = [
+            (seg_key, config.segmentation_dir / filename)
+            for seg_key, filename in zip(
+                manifest["segmentation_keys"], manifest["files"]
+            )
+        ]
+        partition_size = args.partition_size or (
+            0 if args.jobs else auto_partition_size(
+                reference_raster, features, args.memory_mb
+            )
         )
-        for seg_key, filename in zip(manifest["segmentation_keys"], manifest["files"]):
-            seg_path = config.segmentation_dir / filename
-            process_segmentation(
-                seg_key, seg_path, feature_raster, feature_properties, config
+        if partition_size and not args.partition_size and config.verbose:
+            print(
+                f"🧩 Whole-raster counting with {np.dtype(features.raster_dtype).name}"
+                f" feature IDs would exceed {args.memory_mb} MB;"
+                f" partitioning at {partition_size} px"
             )
+        if partition_size or args.jobs:
+            if not run_partitioned(
+                args,
+                partition_size,
+                config,
+                features,
+                reference_raster,
+                seg_paths,
+                profiler,
+            ):
+                return
+        else:
+            with profiler.stage("rasterize", hot=True) as st:
+                feature_raster = rasterize_features(
+                    features, reference_raster, config.verbose
+                )
+                st.add_pixels(feature_raster.size)
+            for seg_key, seg_path in seg_paths:
+                with profiler.stage(seg_key):
+                    process_segmentation(
+                        seg_key,
+                        seg_path,
+                        feature_raster,
+                        features.property_map(),
+                        config,
+                        profiler,
+                    )
         cache_config = {
             "version": 1,
             "shapefile": config.shapefile_path.name,
@@ -251,6 +546,8 @@ def main():
         if args.verbose:
             traceback.print_exc()
         sys.exit(1)
+    finally:
+        profiler.close()
 
 
 if __name__ == "__main__":
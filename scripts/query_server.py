@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+"""Serve narrow queries over an AOI's cluster rasters and intersection caches.
+
+The viewer's folder loader parses every intersection JSON and every k-raster
+before it can draw anything. This server opens the same outputs lazily and
+answers only what is asked:
+
+    GET /manifest                             manifest.json + which k have intersections
+    GET /k/<key>/features/<feature_id>        clusters for a feature   (feature_to_clusters)
+    GET /k/<key>/clusters/<cluster_id>        features for a cluster   (cluster_to_features)
+    GET /k/<key>/clusters/<cluster_id>/similar?top=10&other_k_only=1
+                                              nearest clusters by mean embedding
+    GET /k/<key>/window?bbox=w,s,e,n&level=L  raster window, raw int16 little-endian
+    GET /k/<key>/window?col=&row=&width=&height=&level=L
+
+Window responses carry `X-Shape: rows,cols`, `X-Dtype` and `X-Bounds`. Level L
+(>= 0) reads at 1/2^L resolution; GDAL serves it from the COG's overviews when
+they exist. Windows are clipped to the raster; one that misses it is a 400.
+Decoded windows live in a byte-bounded LRU, so a session's working set stays
+hot without the whole AOI ever sitting in memory.
+
+Intersection lookups never hold a parsed JSON. The first request for a k
+converts `<k>.json` once into sorted CSR arrays under
+`shapefile_intersections/.lookup/<k>/` (rebuilt when the JSON changes) and
+memory-maps them; a lookup is a binary search plus one slice, and only the
+pages it touches are read.
+
+Rasters are read with GDAL's block cache rather than loaded: each request
+touches only the blocks under its window. `ThreadingHTTPServer` starts a
+thread per request, so open datasets are kept in a lock-guarded pool and
+checked out per read - rasterio datasets are not safe to share, but reusing
+a handle keeps its blocks warm.
+
+Usage:
+    python scripts/query_server.py [--aoi auroville-24-10] [--port 8765] [--cache-mb 256]
+"""
+import argparse
+import json
+import math
+import re
+import sys
+import threading
+import traceback
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.errors import WindowError
+from rasterio.windows import Window, from_bounds
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from lib.config import get_current_segmentation, load_config, resolve_aoi_path  # noqa: E402
+from lib.embedding_index import INDEX_FILENAME, EmbeddingIndex  # noqa: E402
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+class LRUCache:
+    """Thread-safe LRU bounded by the summed `size(value)` of its entries."""
+
+    def __init__(self, max_bytes: int, size: Callable[[Any], int]):
+        self.max_bytes = max_bytes
+        self.size = size
+        self.entries: OrderedDict = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def get_or_load(self, key, load: Callable[[], Any]):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        value = load()  # outside the lock: a slow read must not stall hits
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = value
+                self.bytes += self.size(value)
+                while self.bytes > self.max_bytes and len(self.entries) > 1:
+                    _, old = self.entries.popitem(last=False)
+                    self.bytes -= self.size(old)
+            return self.entries[key]
+
+
+class DatasetPool:
+    """Open rasterio datasets per path, lent to one thread at a time."""
+
+    def __init__(self):
+        self.free: dict[Path, list] = defaultdict(list)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def checkout(self, path: Path):
+        with self.lock:
+            ds = self.free[path].pop() if self.free[path] else None
+        if ds is None:
+            ds = rasterio.open(path)
+        try:
+            yield ds
+        finally:
+            with self.lock:
+                self.free[path].append(ds)
+
+
+class IntersectionLookup:
+    """One direction of a k's intersections (e.g. feature -> clusters) as CSR arrays.
+
+    `keys` is sorted; the entries of `keys[i]` are rows `offsets[i]:offsets[i+1]`
+    of `ids`, `pct` and `pixels`, in the JSON's order.
+    """
+
+    FIELDS = ("keys", "offsets", "ids", "pct", "pixels")
+
+    def __init__(self, keys, offsets, ids, pct, pixels):
+        self.keys, self.offsets = keys, offsets
+        self.ids, self.pct, self.pixels = ids, pct, pixels
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, f).nbytes for f in self.FIELDS)
+
+    @staticmethod
+    def from_json(mapping: dict[str, list]) -> "IntersectionLookup":
+        keys = sorted(mapping, key=int)
+        rows = [row for k in keys for row in mapping[k]]
+        return IntersectionLookup(
+            np.asarray([int(k) for k in keys], dtype=np.int64),
+            np.cumsum([0, *(len(mapping[k]) for k in keys)], dtype=np.int64),
+            np.asarray([r[0] for r in rows], dtype=np.int64),
+            np.asarray([r[1] for r in rows], dtype=np.float64),
+            np.asarray([r[2] for r in rows], dtype=np.int64),
+        )
+
+    def save(self, directory: Path, prefix: str) -> None:
+        # Replaced into place, so a reader never maps a half-written file.
+        for f in self.FIELDS:
+            path = directory / f"{prefix}_{f}.npy"
+            tmp = path.with_suffix(".partial.npy")
+            np.save(tmp, getattr(self, f))
+            tmp.replace(path)
+
+    @staticmethod
+    def load(directory: Path, prefix: str) -> "IntersectionLookup":
+        return IntersectionLookup(*(np.load(directory / f"{prefix}_{f}.npy", mmap_mode="r")
+                                    for f in IntersectionLookup.FIELDS))
+
+    def get(self, key: int) -> list:
+        i = int(np.searchsorted(self.keys, key))
+        if i == len(self.keys) or self.keys[i] != key:
+            return []
+        a, b = int(self.offsets[i]), int(self.offsets[i + 1])
+        return [[int(fid), float(pct), int(px)] for fid, pct, px
+                in zip(self.ids[a:b], self.pct[a:b], self.pixels[a:b])]
+
+
+def intersection_lookups(json_path: Path, cache_dir: Path) -> dict[str, IntersectionLookup]:
+    """Memory-mapped lookups for one k, converted from its JSON on first use."""
+    st = json_path.stat()
+    stamp = f"{st.st_size}:{st.st_mtime_ns}"
+    stamp_path = cache_dir / "source"
+    directions = ("feature_to_clusters", "cluster_to_features")
+    if not (stamp_path.exists() and stamp_path.read_text() == stamp):
+        with open(json_path) as f:
+            data = json.load(f)
+        lookups = {d: IntersectionLookup.from_json(data.get(d, {})) for d in directions}
+        del data
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            for d, lookup in lookups.items():
+                lookup.save(cache_dir, d)
+            # Stamp last: it vouches for arrays that are already in place.
+            tmp = stamp_path.with_suffix(".partial")
+            tmp.write_text(stamp)
+            tmp.replace(stamp_path)
+        except OSError as e:  # read-only output tree: serve from memory
+            print(f"⚠️  cannot cache lookups in {cache_dir} ({e}); keeping them in memory")
+            return lookups
+    return {d: IntersectionLookup.load(cache_dir, d) for d in directions}
+
+
+class OutputStore:
+    """The segmentation's manifest, k-rasters and intersection caches for one AOI."""
+
+    def __init__(self, aoi: str, segmentation_dir: Path, intersections_dir: Path,
+                 stats_dir: Path, cache_mb: int):
+        self.aoi = aoi
+        self.segmentation_dir = segmentation_dir
+        self.intersections_dir = intersections_dir
+        self.stats_dir = stats_dir
+        self.embedding_index: EmbeddingIndex | None = None
+        with open(segmentation_dir / "manifest.json") as f:
+            self.manifest = json.load(f)
+        self.files = dict(zip(self.manifest["segmentation_keys"], self.manifest["files"]))
+        self.windows = LRUCache(cache_mb * 1024**2, lambda v: v[0].nbytes)
+        # Memory-mapped, so charged at the most they can hold resident.
+        self.intersections = LRUCache(cache_mb * 1024**2,
+                                      lambda v: sum(lk.nbytes for lk in v.values()))
+        self.datasets = DatasetPool()
+        # LRUCache loads outside its lock; these stop parallel first requests
+        # for one k from converting its JSON twice over the same files.
+        self.lookup_locks: dict[str, threading.Lock] = defaultdict(threading.Lock)
+        self.lookup_locks_lock = threading.Lock()
+        self.meta: dict[str, tuple[int, int, Any]] = {}
+
+    @staticmethod
+    def from_config(config: dict[str, Any], cache_mb: int) -> "OutputStore":
+        aoi_path, aoi_config = config["aoi_path"], config["aoi_config"]
+        _, seg_config = get_current_segmentation(aoi_config)
+        intermediates = aoi_config.get("files", {}).get("intermediates_dir", "intermediates")
+        output_subdir = seg_config.get("output_subdir", "clusters")
+        return OutputStore(
+            config["aoi_name"],
+            resolve_aoi_path(aoi_path, f"{intermediates}/{output_subdir}"),
+            resolve_aoi_path(aoi_path, f"{intermediates}/shapefile_intersections"),
+            resolve_aoi_path(aoi_path, f"{intermediates}/cluster_stats"),
+            cache_mb,
+        )
+
+    def intersection_keys(self) -> list[str]:
+        return [k for k in self.files if (self.intersections_dir / f"{k}.json").exists()]
+
+    def dataset(self, key: str):
+        return self.datasets.checkout(self.segmentation_dir / self.files[key])
+
+    def raster_meta(self, key: str) -> tuple[int, int, Any]:
+        """(width, height, transform) of a k-raster."""
+        if key not in self.meta:
+            with self.dataset(key) as ds:
+                self.meta[key] = (ds.width, ds.height, ds.transform)
+        return self.meta[key]
+
+    def intersection_lookups(self, key: str) -> dict[str, IntersectionLookup]:
+        path = self.intersections_dir / f"{key}.json"
+        if not path.exists():
+            raise FileNotFoundError(f"no intersections for {key}")
+        with self.lookup_locks_lock:
+            lock = self.lookup_locks[key]
+
+        def load():
+            with lock:
+                return intersection_lookups(path, self.intersections_dir / ".lookup" / key)
+
+        return self.intersections.get_or_load(key, load)
+
+    def clusters_for_feature(self, key: str, feature_id: int) -> list:
+        return self.intersection_lookups(key)["feature_to_clusters"].get(feature_id)
+
+    def features_for_cluster(self, key: str, cluster_id: int) -> list:
+        return self.intersection_lookups(key)["cluster_to_features"].get(cluster_id)
+
+    def similar_clusters(self, key: str, cluster_id: int, top: int,
+                         other_k_only: bool) -> list[dict]:
+        if self.embedding_index is None:
+            path = self.stats_dir / INDEX_FILENAME
+            if not path.exists():
+                raise FileNotFoundError(f"no embedding index at {path}; "
+                                        "run cluster_neighbours.py build")
+            self.embedding_index = EmbeddingIndex.load(path)
+        return self.embedding_index.similar(self.aoi, key, cluster_id, top, other_k_only)
+
+    def window(self, key: str, window: Window, level: int) -> tuple[np.ndarray, tuple]:
+        if level < 0:
+            raise ValueError(f"level must be >= 0, got {level}")
+        if window.width <= 0 or window.height <= 0:
+            raise ValueError("window width and height must be positive")
+        width, height, _ = self.raster_meta(key)
+        try:
+            window = window.intersection(Window(0, 0, width, height))
+        except WindowError:
+            raise ValueError(f"window {window} lies outside the {width}x{height} raster")
+        window = window.round_offsets().round_lengths()
+        if window.width <= 0 or window.height <= 0:
+            raise ValueError(f"window {window} lies outside the {width}x{height} raster")
+        cache_key = (key, level, int(window.col_off), int(window.row_off),
+                     int(window.width), int(window.height))
+
+        def load():
+            factor = 2 ** level
+            shape = (math.ceil(window.height / factor), math.ceil(window.width / factor))
+            with self.dataset(key) as ds:
+                arr = ds.read(1, window=window, out_shape=shape,
+                              resampling=Resampling.nearest)
+                return arr, tuple(ds.window_bounds(window))
+
+        return self.windows.get_or_load(cache_key, load)
+
+
+def make_handler(store: OutputStore, log_requests: bool = False) -> type[BaseHTTPRequestHandler]:
+    routes = [
+        (re.compile(r"^/manifest$"), "manifest"),
+        (re.compile(r"^/k/(?P<key>[^/]+)/features/(?P<id>-?\d+)$"), "feature"),
+        (re.compile(r"^/k/(?P<key>[^/]+)/clusters/(?P<id>-?\d+)$"), "cluster"),
+        (re.compile(r"^/k/(?P<key>[^/]+)/clusters/(?P<id>-?\d+)/similar$"), "similar"),
+        (re.compile(r"^/k/(?P<key>[^/]+)/window$"), "window"),
+    ]
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            for pattern, name in routes:
+                match = pattern.match(url.path)
+                if match:
+                    break
+            else:
+                return self.send_json({"error": f"no route for {url.path}"}, 404)
+            params = match.groupdict()
+            if "key" in params and params["key"] not in store.files:
+                return self.send_json({"error": f"unknown k-level {params['key']}",
+                                       "known": list(store.files)}, 404)
+            try:
+                getattr(self, f"get_{name}")(params, query)
+            except (KeyError, ValueError) as e:
+                self.send_json({"error": f"missing or bad parameter: {e}"}, 400)
+            except FileNotFoundError as e:
+                self.send_json({"error": str(e)}, 404)
+            except Exception as e:  # noqa: BLE001 - report, keep serving
+                traceback.print_exc()
+                self.send_json({"error": str(e)}, 500)
+
+        def get_manifest(self, params, query):
+            self.send_json({**store.manifest, "intersections": store.intersection_keys()})
+
+        def get_feature(self, params, query):
+            fid = int(params["id"])
+            self.send_json({"feature_id": fid,
+                            "clusters": store.clusters_for_feature(params["key"], fid)})
+
+        def get_cluster(self, params, query):
+            cid = int(params["id"])
+            self.send_json({"cluster_id": cid,
+                            "features": store.features_for_cluster(params["key"], cid)})
+
+        def get_similar(self, params, query):
+            cid = int(params["id"])
+            try:
+                matches = store.similar_clusters(
+                    params["key"], cid, int(query.get("top", 10)),
+                    query.get("other_k_only", "0") not in ("0", "false", ""))
+            except KeyError as e:
+                return self.send_json({"error": e.args[0]}, 404)
+            self.send_json({"cluster_id": cid, "similar": matches})
+
+        def get_window(self, params, query):
+            key, level = params["key"], int(query.get("level", 0))
+            if "bbox" in query:
+                w, s, e, n = (float(v) for v in query["bbox"].split(","))
+                window = from_bounds(w, s, e, n, store.raster_meta(key)[2])
+            else:
+                window = Window(*(int(query[k]) for k in ("col", "row", "width", "height")))
+            arr, bounds = store.window(key, window, level)
+            body = arr.astype("<i2", copy=False).tobytes()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("X-Shape", f"{arr.shape[0]},{arr.shape[1]}")
+            self.send_header("X-Dtype", "int16")
+            self.send_header("X-Bounds", ",".join(f"{b:.10g}" for b in bounds))
+            self.send_header("Access-Control-Expose-Headers", "X-Shape, X-Dtype, X-Bounds")
+            self.send_cors()
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, payload, status: int = 200):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_cors()
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_cors(self):
+            # The viewer runs on Vite's dev server, a different origin.
+            self.send_header("Access-Control-Allow-Origin", "*")
+
+        def log_message(self, fmt, *args):
+            if log_requests:
+                super().log_message(fmt, *args)
+
+    return Handler
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    ap.add_argument("--aoi", help="AOI key from config.yaml; default aoi.current")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--cache-mb", type=int, default=256,
+                    help="budget for each of the window and intersection caches")
+    ap.add_argument("--log-requests", action="store_true")
+    args = ap.parse_args()
+    try:
+        config = load_config(ROOT, args.aoi)
+    except KeyError as e:
+        raise SystemExit(str(e).strip('"'))
+    store = OutputStore.from_config(config, args.cache_mb)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(store, args.log_requests))
+    print(f"🛰  {config['aoi_name']}: {len(store.files)} k-levels, "
+          f"{len(store.intersection_keys())} with intersections")
+    print(f"   serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""Run an AOI's data pipeline, redoing only the stages whose inputs changed.
+
+The stages, and what each one's digest covers besides its script's source:
+
+    esri_download    sources.esri + AOI bounds/shapefile     -> inputs/esri/ (+ download.json)
+    esri_stitch      inputs/esri/ tiles                       -> intermediates/esri_<aoi>_z<z>_cog.tif
+    aef_stitch       inputs/aef/aef_tiles.zip                 -> sources.aef.input_file (--delta)
+    clusters         segmentation source raster + seg config  -> <clusters>/manifest.json
+    intersections    reference shapefile + k-rasters          -> shapefile_intersections/config.json
+    cluster_stats    k-rasters + segmentation source raster   -> cluster_stats/<k>.json
+    polygons         k-rasters                                -> cluster_polygons/<k>[.s<tol>].fgb
+    embedding_index  cluster_stats/ mean embeddings           -> cluster_stats/embedding_index.npz
+    land_cover       cluster labels + k-rasters               -> land_cover/land-cover_cog.tif
+
+Every digest also covers `scripts/lib/**/*.py`, which all stage scripts
+import, and the AOI's `aoi-paths` entry from the global config.yaml - not the
+whole file, so switching `aoi.current` leaves every AOI's stages fresh.
+
+The ESRI chain and the AEF -> clusters chain share nothing, so with `--jobs 2`
+(the default) they run side by side; intersections, cluster_stats and
+polygons all follow clusters and run alongside each other. land_cover is
+added only for AOIs with a saved labels file (`files.cluster_labels`, else
+`inputs/cluster_labels.json`). A stage is skipped when its digest matches the
+last successful run and its outputs exist; state lives in
+`intermediates/pipeline_state.json`, per-stage logs in `intermediates/logs/`.
+
+Usage:
+    python scripts/run_pipeline.py [--aoi auroville-24-10] [--dry-run] [--force]
+        [--jobs 2] [--profile-dir traces/] [stage ...]
+
+Naming stages runs them plus whatever they depend on.
+"""
+import argparse
+import json
+import sys
+from dataclasses import replace
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from lib.config import get_current_segmentation, get_source_config, load_config  # noqa: E402
+from lib.embedding_index import INDEX_FILENAME  # noqa: E402
+from lib.features import source_files  # noqa: E402
+from lib.pipeline import Stage, critical_path, run_dag, select  # noqa: E402
+
+SCRIPTS = Path(__file__).resolve().parent
+ROOT = SCRIPTS.parent
+
+
+def _command(script: str, aoi: str, *extra: str, profile_dir: Path | None = None,
+             stage: str = "") -> tuple[str, ...]:
+    """`profile_dir` is for scripts that take --profile-out; leave it None otherwise."""
+    cmd = (sys.executable, str(SCRIPTS / script), *extra, "--aoi", aoi)
+    return cmd + ("--profile-out", str(profile_dir / f"{stage}.jsonl")) if profile_dir else cmd
+
+
+def _manifest_inputs(manifest: Path) -> list[Path]:
+    if not manifest.exists():
+        return [manifest]
+    with open(manifest) as f:
+        files = json.load(f)["files"]
+    return [manifest, *(manifest.parent / name for name in files)]
+
+
+def build_stages(aoi: str, aoi_path: Path, aoi_cfg: dict, global_cfg: dict,
+                 profile_dir: Path | None = None) -> list[Stage]:
+    def cmd(script, stage, *extra):
+        return _command(script, aoi, *extra, profile_dir=profile_dir, stage=stage)
+
+    stages = []
+    shared = tuple(sorted((SCRIPTS / "lib").rglob("*.py")))
+    sources = aoi_cfg.get("sources", {})
+    files_cfg = aoi_cfg.get("files", {})
+
+    if "esri" in sources:
+        zoom = sources["esri"]["zoom"]
+        tile_dir = aoi_path / "inputs/esri"
+        aoi_shapefile = aoi_cfg.get("shapefile_path")
+        stages.append(Stage(
+            name="esri_download",
+            command=cmd("esri_tiles.py", "esri_download", "download"),
+            script=SCRIPTS / "esri_tiles.py",
+            inputs=lambda: [aoi_path / aoi_shapefile] if aoi_shapefile else [],
+            # Tiles already on disk are skipped; the record is rewritten regardless.
+            outputs=(tile_dir, tile_dir / "download.json"),
+            config={"esri": sources["esri"], "bounds": aoi_cfg.get("bounds"),
+                    "shapefile_path": aoi_shapefile},
+        ))
+        stages.append(Stage(
+            name="esri_stitch",
+            command=cmd("esri_tiles.py", "esri_stitch", "stitch"),
+            script=SCRIPTS / "esri_tiles.py",
+            inputs=lambda: [tile_dir],
+            outputs=(aoi_path / f"intermediates/esri_{aoi}_z{zoom}_cog.tif",),
+            config={"zoom": zoom,
+                    "overview_levels": sources["esri"].get("overview_levels", 0)},
+            deps=("esri_download",),
+        ))
+
+    aef_zip = aoi_path / "inputs/aef/aef_tiles.zip"
+    aef_out = aoi_path / sources.get("aef", {}).get(
+        "input_file", "intermediates/aef_stitched.tif")
+    if aef_zip.exists():
+        stages.append(Stage(
+            name="aef_stitch",
+            command=cmd("aef_tiles.py", "aef_stitch", "--delta"),
+            script=SCRIPTS / "aef_tiles.py",
+            inputs=lambda: [aef_zip],
+            # A delta with no changed tiles rewrites only the tile manifest.
+            outputs=(aef_out, aef_out.with_suffix(".tiles.json")),
+            config=sources.get("aef"),
+        ))
+
+    seg_name, seg_cfg = get_current_segmentation(aoi_cfg)
+    seg_source = get_source_config(aoi_cfg, seg_cfg["source"])
+    seg_input = aoi_path / seg_source["input_file"]
+    output_subdir = seg_cfg.get("output_subdir", "clusters")
+    manifest = aoi_path / f"intermediates/{output_subdir}/manifest.json"
+    stages.append(Stage(
+        name="clusters",
+        # A stale stage must regenerate, whatever overwrite_existing says.
+        command=cmd("gen_cluster_hierarchy.py", "clusters", "--overwrite"),
+        script=SCRIPTS / "gen_cluster_hierarchy.py",
+        inputs=lambda: [seg_input],
+        outputs=(manifest,),
+        config={"segmentation": seg_name, **seg_cfg},
+        deps=("aef_stitch",) if seg_input == aef_out else (),
+    ))
+
+    intermediates = aoi_path / files_cfg.get("intermediates_dir", "intermediates")
+    seg_manifest = intermediates / output_subdir / "manifest.json"
+    if files_cfg.get("reference_labels"):
+        ref_shapefile = aoi_path / files_cfg["reference_labels"]
+        stages.append(Stage(
+            name="intersections",
+            command=cmd("precompute_shapefile_intersections.py", "intersections"),
+            script=SCRIPTS / "precompute_shapefile_intersections.py",
+            inputs=lambda: [*source_files(ref_shapefile), *_manifest_inputs(seg_manifest)],
+            outputs=(intermediates / "shapefile_intersections/config.json",),
+            # Threshold from the AOI block, cache filename from the global one.
+            config={"aoi": aoi_cfg.get("shapefile_intersection"),
+                    "global": global_cfg.get("shapefile_intersection")},
+            deps=("clusters",),
+        ))
+
+    stages.append(Stage(
+        name="cluster_stats",
+        command=cmd("precompute_cluster_stats.py", "cluster_stats", "--embeddings"),
+        script=SCRIPTS / "precompute_cluster_stats.py",
+        inputs=lambda: [seg_input, *_manifest_inputs(seg_manifest)],
+        outputs=(intermediates / "cluster_stats",),
+        deps=("clusters",),
+    ))
+    stages.append(Stage(
+        name="polygons",
+        command=cmd("polygonize_clusters.py", "polygons"),
+        script=SCRIPTS / "polygonize_clusters.py",
+        inputs=lambda: _manifest_inputs(seg_manifest),
+        outputs=(intermediates / "cluster_polygons/index.json",),
+        deps=("clusters",),
+    ))
+    stats_dir = intermediates / "cluster_stats"
+    stages.append(Stage(
+        name="embedding_index",
+        command=_command("cluster_neighbours.py", aoi, "build"),
+        script=SCRIPTS / "cluster_neighbours.py",
+        inputs=lambda: sorted(p for p in stats_dir.glob("*") if p.name != INDEX_FILENAME),
+        outputs=(stats_dir / INDEX_FILENAME,),
+        deps=("cluster_stats",),
+    ))
+
+    cluster_labels = aoi_path / files_cfg.get("cluster_labels", "inputs/cluster_labels.json")
+    if cluster_labels.exists():
+        colors = ROOT / "app/hierarchy-colors.json"
+        stages.append(Stage(
+            name="land_cover",
+            command=cmd("export_land_cover.py", "land_cover"),
+            script=SCRIPTS / "export_land_cover.py",
+            inputs=lambda: [cluster_labels, colors, *_manifest_inputs(seg_manifest)],
+            outputs=(intermediates / "land_cover/land-cover_cog.tif",),
+            deps=("clusters",),
+        ))
+    aoi_entry = {aoi: global_cfg["aoi-paths"][aoi]}
+    return [replace(s, shared=shared, config={"aoi-paths": aoi_entry, "stage": s.config})
+            for s in stages]
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    ap.add_argument("stages", nargs="*", help="run only these stages and their upstream")
+    ap.add_argument("--aoi", help="AOI key from config.yaml; default aoi.current")
+    ap.add_argument("--jobs", type=int, default=2, help="stages to run at once")
+    ap.add_argument("--force", action="store_true", help="rerun even up-to-date stages")
+    ap.add_argument("--dry-run", action="store_true",
+                    help="report which stages would run, run nothing")
+    ap.add_argument("--profile-dir", help="pass --profile-out <dir>/<stage>.jsonl to each stage")
+    args = ap.parse_args()
+
+    try:
+        cfg = load_config(ROOT, args.aoi)
+    except KeyError as e:
+        raise SystemExit(str(e).strip('"'))
+    aoi, aoi_path = cfg["aoi_name"], Path(cfg["aoi_path"]).resolve()
+    profile_dir = Path(args.profile_dir).resolve() if args.profile_dir else None
+    try:
+        stages = select(build_stages(aoi, aoi_path, cfg["aoi_config"],
+                                     cfg["global_config"], profile_dir), args.stages)
+    except KeyError as e:
+        raise SystemExit(str(e).strip('"'))
+    print(f"=== pipeline - {aoi}: {', '.join(s.name for s in stages)} ===")
+
+    results = run_dag(stages, aoi_path / "intermediates/pipeline_state.json",
+                      aoi_path / "intermediates/logs", jobs=args.jobs,
+                      force=args.force, dry_run=args.dry_run)
+
+    chain, total = critical_path(stages, results)
+    print(f"\n  {'stage':<17}{'status':<10}{'seconds':>8}")
+    for r in results:
+        print(f"  {r.name:<17}{r.status:<10}{r.seconds:8.1f}")
+    if total:
+        print(f"critical path: {' -> '.join(chain)}  ({total:.1f}s)")
+    if any(r.status in ("failed", "blocked") for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()